@@ -0,0 +1,180 @@
+# Suite of functionalities for rendering browse images of products
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Headless browse images and thumbnails for many products at once.
+
+Each (product, layer) is one task of a process pool. A layer is read once,
+decimated by GDAL to the largest browse size (from the COG overviews when the
+product has them), mapped through a matplotlib colormap straight into an RGBA
+array, with invalid pixels transparent, and written by PIL at every size and
+format. No figure is drawn and no GUI backend is involved. A JSON index lists
+the images of every product with the bounds of the layer.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image, features
+
+logger = logging.getLogger('create_ifg')
+
+# (layer, band, style) rendered per product
+BROWSE_LAYERS = (('filt_topophase.flat.geo', 1, 'phase'),
+                 ('filt_topophase.unw.geo', 2, 'unwrapped'),
+                 ('phsig.cor.geo', 1, 'coherence'))
+
+# style -> (colormap, vmin, vmax); None limits are the 2nd/98th percentiles
+BROWSE_STYLES = {'phase': ('rainbow', -np.pi, np.pi),
+                 'unwrapped': ('jet', None, None),
+                 'coherence': ('gray', 0.0, 1.0)}
+
+# (label, longest side in pixels), largest first
+BROWSE_SIZES = (('browse', 1024), ('thumb', 256))
+BROWSE_FORMATS = ('png', 'webp')
+
+
+def get_colormap(name):
+    '''matplotlib colormap by name, without importing pyplot.'''
+    try:
+        from matplotlib import colormaps
+        return colormaps[name]
+    except ImportError:
+        from matplotlib import cm
+        return cm.get_cmap(name)
+
+
+def find_layer(prod_dir, layer):
+    '''Path to read layer from: its COG, its .vrt sidecar or the file, or None.'''
+    for path in (os.path.join(prod_dir, layer + '.tif'), os.path.join(prod_dir, layer + '.vrt'),
+                 os.path.join(prod_dir, layer)):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_decimated(path, band=1, max_size=1024):
+    '''
+        Band of a raster read at most max_size pixels on a side, and its
+        bounds (min_lon, min_lat, max_lon, max_lat).
+    '''
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError("Failed to open {}".format(path))
+    scale = max(1.0, max(ds.RasterXSize, ds.RasterYSize) / float(max_size))
+    width = max(1, int(ds.RasterXSize / scale))
+    length = max(1, int(ds.RasterYSize / scale))
+    data = ds.GetRasterBand(band).ReadAsArray(buf_xsize=width, buf_ysize=length)
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    x1, y1 = x0 + dx * ds.RasterXSize, y0 + dy * ds.RasterYSize
+    ds = None
+    return data, (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+
+def colorize(data, style):
+    '''RGBA uint8 image of data in style; zero and non-finite pixels are transparent.'''
+    cmap, vmin, vmax = BROWSE_STYLES[style]
+    valid = (data != 0) & np.isfinite(data)
+    values = np.angle(data) if np.iscomplexobj(data) else data.astype(np.float32)
+    if vmin is None:
+        vmin, vmax = np.percentile(values[valid], (2, 98)) if valid.any() else (0.0, 1.0)
+    scaled = np.clip((values - vmin) / ((vmax - vmin) or 1.0), 0.0, 1.0)
+    rgba = get_colormap(cmap)(np.where(valid, scaled, 0.0), bytes=True)
+    rgba[..., 3] = np.where(valid, 255, 0)
+    return rgba
+
+
+def render_layer(task):
+    '''
+        Write the browse images of one layer of a product, task being
+        (prod_dir, layer, band, style, sizes, formats). Returns (prod_dir,
+        layer, entry for the index), the entry being None if there is no such
+        layer.
+    '''
+    prod_dir, layer, band, style, sizes, formats = task
+    path = find_layer(prod_dir, layer)
+    if path is None:
+        return prod_dir, layer, None
+    data, bounds = read_decimated(path, band, max(size for _, size in sizes))
+    image = Image.fromarray(colorize(data, style), 'RGBA')
+
+    images = {}
+    for label, size in sizes:
+        if max(image.size) > size:
+            image = image.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+        images[label] = {'width': image.width, 'height': image.height}
+        for fmt in formats:
+            name = "{}.{}.{}".format(layer, label, fmt)
+            options = {'quality': 90} if fmt == 'webp' else {'optimize': True}
+            image.save(os.path.join(prod_dir, name), format=fmt.upper(), **options)
+            images[label][fmt] = name
+    return prod_dir, layer, {'source': os.path.basename(path), 'bounds': bounds,
+                             'images': images}
+
+
+def generate_browse_images(prod_dirs, index_file, layers=BROWSE_LAYERS, sizes=BROWSE_SIZES,
+                           formats=BROWSE_FORMATS, max_workers=None):
+    '''
+        Render the browse images of the layers of every product directory
+        into that directory, max_workers processes at a time (default: one
+        per core), and write the JSON index {product: {'path', 'layers':
+        {layer: {'source', 'bounds', 'images': {label: {'width', 'height',
+        <format>: file}}}}}} to index_file. Returns the index.
+    '''
+    sizes = sorted(sizes, key=lambda size: size[1], reverse=True)
+    if 'webp' in formats and not features.check('webp'):
+        logger.info("generate_browse_images : PIL has no WebP support, writing {} only".format(
+            [fmt for fmt in formats if fmt != 'webp']))
+        formats = [fmt for fmt in formats if fmt != 'webp']
+    prod_dirs = [os.path.abspath(prod_dir) for prod_dir in prod_dirs]
+    tasks = [(prod_dir, layer, band, style, sizes, formats)
+             for prod_dir in prod_dirs for layer, band, style in layers]
+
+    index = {os.path.basename(prod_dir): {'path': prod_dir, 'layers': {}}
+             for prod_dir in prod_dirs}
+    t0 = time.time()
+    # colour mapping and PNG/WebP encoding are CPU bound: one process per task
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for prod_dir, layer, entry in pool.map(render_layer, tasks):
+            if entry is not None:
+                index[os.path.basename(prod_dir)]['layers'][layer] = entry
+
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=2)
+    logger.info("generate_browse_images : {} layers of {} products in {:.1f} s, index {}".format(
+        sum(len(entry['layers']) for entry in index.values()), len(index), time.time() - t0,
+        index_file))
+    return index
+
+
+def browse_files(index):
+    '''Names of the image files listed in an index, per product.'''
+    return {product: [image[fmt] for entry in value['layers'].values()
+                      for image in entry['images'].values()
+                      for fmt in image if fmt not in ('width', 'height')]
+            for product, value in index.items()}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render browse images and thumbnails of products "
+                                                 "and write a JSON index of them")
+    parser.add_argument('prod_dirs', nargs='+', help='product directories.')
+    parser.add_argument('-i', '--index', type=str, required=True,
+                        help='JSON index file to write.')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of processes (default: one per core).')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format="[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s",
+                        level=logging.INFO)
+    args = parse_args()
+    generate_browse_images(args.prod_dirs, args.index, max_workers=args.workers)
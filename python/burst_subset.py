@@ -0,0 +1,308 @@
+# Suite of functionalities for burst-level subsetting of remote Sentinel-1 SLCs
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Fetch only the bursts of a remote SLC zip that intersect an area of interest.
+
+The zip central directory, manifest.safe and the annotation XMLs are read with
+HTTP range requests. The burst list and geolocation grid of each annotation
+give the footprint and byte offset of every burst in its measurement TIFF.
+Measurement TIFFs are stored uncompressed in the zip, so the TIFF header and
+IFD plus the lines of the intersecting bursts are fetched directly.
+
+The result is a minimal SAFE. Each measurement TIFF is rewritten as a single
+strip holding only the run of bursts that intersect the area of interest, and
+the burst list of its annotation is cut down to those bursts with their byte
+offsets in the new TIFF. Image line numbers in the annotation, calibration and
+noise XMLs are shifted by the first kept line, so topsApp ingests the subset
+like a full SAFE and never sees bursts without data. Swaths with no burst in
+the area are left out.
+"""
+import logging
+import os
+import struct
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from safe_zip import parse_swath_file, select_safe_members
+from transfer import HTTPRangeFile
+
+logger = logging.getLogger('create_ifg')
+
+MB = 1024 * 1024
+
+# TIFF field type -> size in bytes
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2,
+                   9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_PHOTOMETRIC = 262
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIG = 284
+TIFF_SAMPLE_FORMAT = 339
+
+
+def member_data_offset(rangefile, info):
+    '''Offset in the archive of the data of an uncompressed zip member.'''
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise RuntimeError("{} is compressed, cannot read bursts by range".format(info.filename))
+    header = rangefile.read_range(info.header_offset, 30)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+
+def read_tiff_layout(read_range):
+    '''
+        Parse the IFDs of a classic TIFF through read_range(offset, length).
+        Returns the image width/height, sample type, bytes per line and the
+        (offset, length) ranges holding the header, IFDs and out-of-line tag
+        values.
+    '''
+    header = read_range(0, 8)
+    order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if order is None:
+        raise RuntimeError("Not a TIFF file")
+    version, ifd_offset = struct.unpack(order + 'HI', header[2:8])
+    if version != 42:
+        raise RuntimeError("Only classic TIFF is supported (version {})".format(version))
+
+    ranges = [(0, 8)]
+    tags = {}
+    while ifd_offset:
+        count = struct.unpack(order + 'H', read_range(ifd_offset, 2))[0]
+        ifd_length = 2 + 12 * count + 4
+        ifd = read_range(ifd_offset, ifd_length)
+        ranges.append((ifd_offset, ifd_length))
+        for i in range(count):
+            entry = ifd[2 + 12 * i:14 + 12 * i]
+            tag, ftype, nvalues = struct.unpack(order + 'HHI', entry[:8])
+            size = TIFF_TYPE_SIZES.get(ftype, 1) * nvalues
+            if size > 4:
+                ranges.append((struct.unpack(order + 'I', entry[8:12])[0], size))
+            elif ftype == 3:
+                tags.setdefault(tag, struct.unpack(order + 'H', entry[8:10])[0])
+            elif ftype == 4:
+                tags.setdefault(tag, struct.unpack(order + 'I', entry[8:12])[0])
+        ifd_offset = struct.unpack(order + 'I', ifd[-4:])[0]
+
+    width = tags[TIFF_IMAGE_WIDTH]
+    bits_per_sample = tags.get(TIFF_BITS_PER_SAMPLE, 32)
+    samples = tags.get(TIFF_SAMPLES_PER_PIXEL, 1)
+    return {'width': width, 'height': tags[TIFF_IMAGE_LENGTH],
+            'bits_per_sample': bits_per_sample, 'samples': samples,
+            'sample_format': tags.get(TIFF_SAMPLE_FORMAT, 1),
+            'bytes_per_line': width * bits_per_sample * samples // 8, 'ranges': ranges}
+
+
+def tiff_header(layout, height):
+    '''
+        Header and IFD of a little-endian classic TIFF with the width and
+        sample type of a single-sample layout, height lines long and stored
+        uncompressed as one strip right after the IFD.
+    '''
+    entries = [(TIFF_IMAGE_WIDTH, 4, layout['width']), (TIFF_IMAGE_LENGTH, 4, height),
+               (TIFF_BITS_PER_SAMPLE, 3, layout['bits_per_sample']), (TIFF_COMPRESSION, 3, 1),
+               (TIFF_PHOTOMETRIC, 3, 1), (TIFF_STRIP_OFFSETS, 4, None),
+               (TIFF_SAMPLES_PER_PIXEL, 3, 1), (TIFF_ROWS_PER_STRIP, 4, height),
+               (TIFF_STRIP_BYTE_COUNTS, 4, height * layout['bytes_per_line']),
+               (TIFF_PLANAR_CONFIG, 3, 1), (TIFF_SAMPLE_FORMAT, 3, layout['sample_format'])]
+    data_offset = 8 + 2 + 12 * len(entries) + 4
+    header = b'II' + struct.pack('<HI', 42, 8) + struct.pack('<H', len(entries))
+    for tag, ftype, value in entries:
+        value = data_offset if value is None else value
+        header += struct.pack('<HHI', tag, ftype, 1)
+        header += struct.pack('<HH', value, 0) if ftype == 3 else struct.pack('<I', value)
+    return header + struct.pack('<I', 0)
+
+
+def read_burst_geometry(annotation):
+    '''
+        List the bursts of a swath annotation XML with their first line, number
+        of lines, byte offset in the measurement TIFF, lat/lon bounding box
+        (min_lat, max_lat, min_lon, max_lon) from the geolocation grid and
+        burst ID (annotated from IPF 3.40 on, None before).
+    '''
+    root = ET.fromstring(annotation)
+    lines_per_burst = int(root.find('swathTiming/linesPerBurst').text)
+    grid = [(int(pt.find('line').text), float(pt.find('latitude').text),
+             float(pt.find('longitude').text))
+            for pt in root.iter('geolocationGridPoint')]
+    grid_lines = sorted(set(line for line, _, _ in grid))
+
+    bursts = []
+    for i, burst in enumerate(root.findall('swathTiming/burstList/burst')):
+        first = i * lines_per_burst
+        last = first + lines_per_burst - 1
+        lo = max([line for line in grid_lines if line <= first] or grid_lines[:1])
+        hi = min([line for line in grid_lines if line >= last] or grid_lines[-1:])
+        lats = [lat for line, lat, _ in grid if lo <= line <= hi]
+        lons = [lon for line, _, lon in grid if lo <= line <= hi]
+        burst_id = burst.find('burstId')
+        bursts.append({'index': i, 'first_line': first, 'lines': lines_per_burst,
+                       'azimuth_time': burst.find('azimuthTime').text,
+                       'burst_id': burst_id.text if burst_id is not None else None,
+                       'byte_offset': int(burst.find('byteOffset').text),
+                       'bbox': (min(lats), max(lats), min(lons), max(lons))})
+    return bursts
+
+
+def is_swath_annotation(name):
+    '''True for the product annotation of a swath, not its calibration/noise/RFI ones.'''
+    return '/annotation/' in name and '/calibration/' not in name and '/rfi/' not in name
+
+
+def shift_lines(root, first_line, tags=('line', 'firstAzimuthLine', 'lastAzimuthLine')):
+    '''Shift the image line numbers (single or space-separated) under root by -first_line.'''
+    for tag in tags:
+        for elem in root.iter(tag):
+            elem.text = ' '.join(str(int(line) - first_line) for line in elem.text.split())
+
+
+def trim_annotation(annotation, first, count, data_offset, bytes_per_line):
+    '''
+        Swath annotation XML with its burst list cut down to the count bursts
+        from index first, stored one after the other from data_offset in the
+        rewritten measurement TIFF.
+    '''
+    root = ET.fromstring(annotation)
+    lines_per_burst = int(root.find('swathTiming/linesPerBurst').text)
+    burst_list = root.find('swathTiming/burstList')
+    for i, burst in enumerate(burst_list.findall('burst')):
+        if first <= i < first + count:
+            burst.find('byteOffset').text = str(
+                data_offset + (i - first) * lines_per_burst * bytes_per_line)
+        else:
+            burst_list.remove(burst)
+    burst_list.set('count', str(count))
+    number_of_lines = root.find('imageAnnotation/imageInformation/numberOfLines')
+    if number_of_lines is not None:
+        number_of_lines.text = str(count * lines_per_burst)
+    shift_lines(root, first * lines_per_burst)
+    return ET.tostring(root, encoding='UTF-8')
+
+
+def bbox_intersects(a, b):
+    '''True if two (min_lat, max_lat, min_lon, max_lon) boxes overlap.'''
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+
+def select_bursts(bursts, bbox, margin=0.05):
+    '''Bursts whose footprint intersects bbox grown by margin degrees.'''
+    aoi = (bbox[0] - margin, bbox[1] + margin, bbox[2] - margin, bbox[3] + margin)
+    return [burst for burst in bursts if bbox_intersects(burst['bbox'], aoi)]
+
+
+def split_range(start, length, chunk_size):
+    return [(offset, min(chunk_size, start + length - offset))
+            for offset in range(start, start + length, chunk_size)]
+
+
+def subset_safe(url, out_dir, bbox, swaths=None, polarization='vv', client=None,
+                max_workers=4, chunk_size=32 * MB, margin=0.05):
+    '''
+        Write to out_dir a minimal SAFE of the remote SLC zip at url, holding
+        only the bursts of the requested swaths and polarization that
+        intersect bbox = (min_lat, max_lat, min_lon, max_lon).
+
+        Raises RuntimeError if a measurement TIFF cannot be read by range
+        (compressed member, not a single-sample classic TIFF), before any file
+        is written, and ValueError if no burst intersects bbox.
+
+        Returns a dict with the SAFE path, the selected burst indices per swath,
+        the bytes transferred and the size of the full zip.
+    '''
+    rangefile = HTTPRangeFile(url, client=client)
+    zf = zipfile.ZipFile(rangefile)
+    infos = {info.filename: info for info in zf.infolist()}
+    members = select_safe_members(infos, swaths, polarization)
+
+    annotations = {}
+    for name in members:
+        if is_swath_annotation(name):
+            annotations[parse_swath_file(name)] = zf.read(name)
+
+    # contiguous run of intersecting bursts per measurement TIFF
+    plans = {}
+    for name in members:
+        if not name.endswith('.tiff'):
+            continue
+        swath_pol = parse_swath_file(name)
+        bursts = select_bursts(read_burst_geometry(annotations[swath_pol]), bbox, margin)
+        if not bursts:
+            logger.info("subset_safe : {} : no burst in the area, skipping swath".format(
+                os.path.basename(name)))
+            continue
+        base = member_data_offset(rangefile, infos[name])
+        layout = read_tiff_layout(lambda offset, length: rangefile.read_range(base + offset, length))
+        if layout['samples'] != 1:
+            raise RuntimeError("{} has {} samples per pixel".format(name, layout['samples']))
+        first, last = bursts[0]['index'], bursts[-1]['index']
+        plans[swath_pol] = {'base': base, 'layout': layout, 'first': first,
+                            'bursts': read_burst_geometry(annotations[swath_pol])[first:last + 1]}
+    if not plans:
+        raise ValueError("No burst of {} intersects {}".format(url, bbox))
+
+    jobs = []
+    selected = {}
+    for name in members:
+        swath_pol = parse_swath_file(name)
+        if swath_pol is not None and swath_pol not in plans:
+            continue
+        path = os.path.join(out_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        plan = plans.get(swath_pol)
+        if plan is None:
+            data = zf.read(name)
+        else:
+            bursts, layout = plan['bursts'], plan['layout']
+            lines = bursts[0]['lines']
+            header = tiff_header(layout, len(bursts) * lines)
+            if name.endswith('.tiff'):
+                selected[swath_pol[0]] = [burst['index'] for burst in bursts]
+                logger.info("subset_safe : {} : bursts {}".format(os.path.basename(name),
+                                                                  selected[swath_pol[0]]))
+                position = len(header)
+                for burst in bursts:
+                    length = burst['lines'] * layout['bytes_per_line']
+                    jobs.extend((path, plan['base'] + offset,
+                                 position + offset - burst['byte_offset'], chunk)
+                                for offset, chunk in split_range(burst['byte_offset'], length,
+                                                                 chunk_size))
+                    position += length
+                with open(path, 'wb') as fw:
+                    fw.write(header)
+                    fw.truncate(position)
+                continue
+            if is_swath_annotation(name):
+                data = trim_annotation(annotations[swath_pol], plan['first'], len(bursts),
+                                       len(header), layout['bytes_per_line'])
+            else:
+                root = ET.fromstring(zf.read(name))
+                shift_lines(root, plan['first'] * lines)
+                data = ET.tostring(root, encoding='UTF-8')
+        with open(path, 'wb') as fw:
+            fw.write(data)
+
+    def fetch(job):
+        path, offset, position, length = job
+        data = rangefile.read_range(offset, length)
+        with open(path, 'r+b') as fw:
+            fw.seek(position)
+            fw.write(data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(fetch, jobs))
+
+    safe_dir = os.path.join(out_dir, next(iter(infos)).split('/')[0])
+    logger.info("subset_safe : {} : fetched {:.1f} of {:.1f} MB in {} requests".format(
+        os.path.basename(safe_dir), rangefile.bytes_read / MB, rangefile.size / MB,
+        rangefile.requests))
+    return {'safe': safe_dir, 'bursts': selected,
+            'bytes': rangefile.bytes_read, 'full_size': rangefile.size}
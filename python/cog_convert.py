@@ -0,0 +1,93 @@
+# Suite of functionalities for converting ISCE rasters to cloud-optimized GeoTIFFs
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Write geocoded ISCE layers as cloud-optimized GeoTIFFs (COGs).
+
+ISCE writes flat binaries described by .xml and .vrt sidecars, which every
+reader has to scan at full resolution. A COG of the same layer is tiled,
+DEFLATE-compressed and carries internal overviews, so plots, mosaics and
+time-series steps can read a decimated level or a window with a few reads.
+The ISCE binary and its sidecars are left in place for the ISCE tools.
+"""
+import glob
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+logger = logging.getLogger('create_ifg')
+
+# geocoded layers of a topsApp merged/ directory
+COG_PATTERNS = ('*.geo',)
+
+
+def get_resampling(path):
+    '''Overview resampling for a layer: labels must not be averaged.'''
+    return 'NEAREST' if 'conncomp' in os.path.basename(path) else 'AVERAGE'
+
+
+def convert_to_cog(src, dest, blocksize=512, compress='DEFLATE', num_threads=2):
+    '''
+        Write the raster src (read through its .vrt sidecar when there is one)
+        as a COG at dest. Uses the COG driver of GDAL >= 3.1, or a tiled GTiff
+        with copied overviews on older versions.
+    '''
+    if os.path.exists(src + '.vrt'):
+        src = src + '.vrt'
+    resampling = get_resampling(dest)
+    tmp = dest + '.tmp.tif'
+
+    if gdal.GetDriverByName('COG') is not None:
+        ds = gdal.Translate(tmp, src, format='COG', creationOptions=[
+            'BLOCKSIZE={}'.format(blocksize), 'COMPRESS={}'.format(compress),
+            'OVERVIEWS=AUTO', 'RESAMPLING={}'.format(resampling),
+            'NUM_THREADS={}'.format(num_threads), 'BIGTIFF=IF_SAFER'])
+    else:
+        # overviews are built on a plain tiled copy, then copied ahead of the data
+        stage = dest + '.stage.tif'
+        ds = gdal.Translate(stage, src, format='GTiff', creationOptions=[
+            'TILED=YES', 'BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize),
+            'BIGTIFF=IF_SAFER'])
+        if ds is None:
+            raise RuntimeError("Failed to read {}".format(src))
+        levels = []
+        factor = 2
+        while max(ds.RasterXSize, ds.RasterYSize) // factor >= blocksize:
+            levels.append(factor)
+            factor *= 2
+        if levels:
+            ds.BuildOverviews(resampling, levels)
+        ds = None
+        ds = gdal.Translate(tmp, stage, format='GTiff', creationOptions=[
+            'TILED=YES', 'BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize),
+            'COMPRESS={}'.format(compress), 'COPY_SRC_OVERVIEWS=YES',
+            'NUM_THREADS={}'.format(num_threads), 'BIGTIFF=IF_SAFER'])
+        os.remove(stage)
+    if ds is None:
+        raise RuntimeError("Failed to write COG of {}".format(src))
+    ds = None
+    os.replace(tmp, dest)
+    return dest
+
+
+def convert_product_layers(prod_dir, patterns=COG_PATTERNS, max_workers=4):
+    '''
+        Convert the geocoded layers of prod_dir into <layer>.tif COGs, several
+        layers at a time. Returns the paths of the COGs written.
+    '''
+    layers = sorted(set(path for pattern in patterns
+                        for path in glob.glob(os.path.join(prod_dir, pattern))))
+
+    def convert(path):
+        cog = convert_to_cog(path, path + '.tif')
+        logger.info("convert_product_layers : {} ({:.1f} -> {:.1f} MB)".format(
+            os.path.basename(cog), os.path.getsize(path) / 1024**2,
+            os.path.getsize(cog) / 1024**2))
+        return cog
+
+    # GDAL releases the GIL while translating, so threads convert in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(convert, layers))
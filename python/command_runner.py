@@ -0,0 +1,146 @@
+# Suite of functionalities for running external commands with resource accounting
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Run PGE commands (ISCE applications, dem.py, ...) and account for their cost.
+
+The output of a command is drained on a background thread into a buffered log
+file, keeping only a bounded tail of lines in memory, so chatty commands are
+not slowed down by per-line logging. Once the command exits it is waited for
+without being reaped, so that the I/O counters of its /proc entry (which
+include the children it reaped) can still be read. It is then reaped with
+wait4 for its own peak RSS and CPU times.
+"""
+import collections
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('create_ifg')
+
+
+class CommandResult:
+    """Exit code, timings, resource usage and output tail of a finished command."""
+
+    def __init__(self, cmd, exit_code, wall_time, user_time, sys_time, maxrss_kb,
+                 read_bytes, write_bytes, log_file=None, tail=(), output=None):
+        self.cmd = cmd
+        self.exit_code = exit_code
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.sys_time = sys_time
+        self.maxrss_kb = maxrss_kb
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.log_file = log_file
+        self.tail = list(tail)
+        self.output = output
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+    def check(self):
+        '''Raise CalledProcessError, with the output tail, if the command failed.'''
+        if not self.ok:
+            raise subprocess.CalledProcessError(self.exit_code, self.cmd,
+                                                output="\n".join(self.tail))
+        return self
+
+    def as_dict(self):
+        '''Accounting fields, e.g. for a JSON manifest.'''
+        return {'exit_code': self.exit_code, 'wall_time': self.wall_time,
+                'user_time': self.user_time, 'sys_time': self.sys_time,
+                'maxrss_kb': self.maxrss_kb, 'read_bytes': self.read_bytes,
+                'write_bytes': self.write_bytes, 'log_file': self.log_file}
+
+    def __repr__(self):
+        return ("CommandResult(exit_code={}, wall_time={:.1f}, user_time={:.1f}, "
+                "sys_time={:.1f}, maxrss_kb={}, read_bytes={}, write_bytes={})".format(
+                    self.exit_code, self.wall_time, self.user_time, self.sys_time,
+                    self.maxrss_kb, self.read_bytes, self.write_bytes))
+
+
+def read_proc_io(pid):
+    '''read_bytes/write_bytes of /proc/<pid>/io, or None when unavailable.'''
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _drain(stream, log, tail, output):
+    for line in iter(stream.readline, b''):
+        if log is not None:
+            log.write(line)
+        tail.append(line)
+        if output is not None:
+            output.append(line)
+    stream.close()
+
+
+def run_command(cmd, log_file=None, cwd=None, env=None, shell=False, tail_lines=200,
+                capture=False, append=False, cpus=None):
+    '''
+        Run cmd (an argument list, or a command line with shell=True) with
+        stdout and stderr drained into log_file, keeping the last tail_lines
+        lines in memory. With capture=True the whole output is also returned
+        in result.output. cpus pins the command and its children to a set of
+        CPU ids, through taskset so that the affinity is set before exec, or
+        right after the fork when taskset is not installed. Returns a CommandResult; the caller decides whether
+        a non-zero exit code is an error (see CommandResult.check).
+    '''
+    if not shell and isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    cmd_line = cmd if isinstance(cmd, str) else " ".join(shlex.quote(arg) for arg in cmd)
+    logger.info("Calling : {}".format(cmd_line))
+
+    log = open(log_file, 'ab' if append else 'wb', buffering=1024 * 1024) if log_file else None
+    tail = collections.deque(maxlen=tail_lines)
+    output = [] if capture else None
+    t0 = time.time()
+    taskset = shutil.which('taskset') if cpus else None
+    if taskset:
+        # no preexec_fn: it is not safe to use from the threads jobs run on
+        cpu_list = ",".join(str(cpu) for cpu in sorted(cpus))
+        cmd = [taskset, '-c', cpu_list] + (['/bin/sh', '-c', cmd] if shell else list(cmd))
+        shell = False
+    try:
+        p = subprocess.Popen(cmd, shell=shell, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if cpus and not taskset:
+            os.sched_setaffinity(p.pid, cpus)
+        drain = threading.Thread(target=_drain, args=(p.stdout, log, tail, output), daemon=True)
+        drain.start()
+
+        # wait without reaping so /proc/<pid>/io is still readable
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(p.pid)
+        _, status, rusage = os.wait4(p.pid, 0)
+        wall_time = time.time() - t0
+        p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        drain.join()
+    finally:
+        if log is not None:
+            log.close()
+
+    if io is None:
+        # block counts are in 512 byte units
+        io = (rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+    result = CommandResult(cmd_line, p.returncode, wall_time, rusage.ru_utime, rusage.ru_stime,
+                           rusage.ru_maxrss, io[0], io[1], log_file,
+                           [line.decode('utf-8', 'replace').rstrip() for line in tail],
+                           b''.join(output) if capture else None)
+    logger.info("run_command : exit {} in {:.1f} s (user {:.1f} s, sys {:.1f} s), "
+                "peak RSS {:.0f} MB, read {:.1f} MB, written {:.1f} MB".format(
+                    result.exit_code, result.wall_time, result.user_time, result.sys_time,
+                    result.maxrss_kb / 1024, result.read_bytes / 1024**2,
+                    result.write_bytes / 1024**2))
+    return result
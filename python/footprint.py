@@ -0,0 +1,95 @@
+# Suite of functionalities for deriving product footprints from rasters
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Footprint of the valid data of a geocoded product.
+
+The first band of a geocoded layer is read decimated to at most ``max_size``
+pixels on a side (GDAL serves this from an overview level when the layer is a
+COG), non-zero pixels are taken as valid, and the mask is vectorised with
+GDAL's polygonize. The largest polygon, without its holes and simplified to
+about two decimated pixels, is the footprint.
+"""
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+logger = logging.getLogger('create_ifg')
+
+# layers tried in order, by preference; a .tif COG is used when present
+FOOTPRINT_LAYERS = ('filt_topophase.unw.geo', 'filt_topophase.flat.geo', 'phsig.cor.geo',
+                    'topophase.cor.geo')
+
+
+def get_raster_footprint(raster, max_size=1024, tolerance=None):
+    '''
+        GeoJSON Polygon coordinates [[[lon, lat], ...]] of the valid
+        (non-zero) pixels of raster, or None if it has none.
+    '''
+    ds = gdal.Open(raster, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError("Failed to open {}".format(raster))
+    scale = max(1.0, max(ds.RasterXSize, ds.RasterYSize) / float(max_size))
+    width = max(1, int(ds.RasterXSize / scale))
+    length = max(1, int(ds.RasterYSize / scale))
+    data = ds.GetRasterBand(1).ReadAsArray(buf_xsize=width, buf_ysize=length)
+    x0, dx, rx, y0, ry, dy = ds.GetGeoTransform()
+    # pixel size of the decimated grid
+    dx, dy = dx * ds.RasterXSize / width, dy * ds.RasterYSize / length
+    projection = ds.GetProjection()
+    ds = None
+
+    mask = (data != 0) & np.isfinite(data)
+    if not mask.any():
+        return None
+
+    mem = gdal.GetDriverByName('MEM').Create('', width, length, 1, gdal.GDT_Byte)
+    mem.SetGeoTransform((x0, dx, rx, y0, ry, dy))
+    if projection:
+        mem.SetProjection(projection)
+    band = mem.GetRasterBand(1)
+    band.WriteArray(mask.astype(np.uint8))
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = ogr.GetDriverByName('Memory').CreateDataSource('').CreateLayer('mask', srs=srs)
+    layer.CreateField(ogr.FieldDefn('valid', ogr.OFTInteger))
+    gdal.Polygonize(band, band, layer, 0, [], callback=None)
+
+    largest = None
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if largest is None or geometry.GetArea() > largest.GetArea():
+            largest = geometry.Clone()
+    if largest is None:
+        return None
+
+    # keep the outline only: holes (e.g. decorrelated water) are still covered
+    outline = ogr.Geometry(ogr.wkbPolygon)
+    outline.AddGeometry(largest.GetGeometryRef(0))
+    if tolerance is None:
+        tolerance = 2 * max(abs(dx), abs(dy))
+    outline = outline.SimplifyPreserveTopology(tolerance)
+    ring = outline.GetGeometryRef(0)
+    coordinates = [[ring.GetX(i), ring.GetY(i)] for i in range(ring.GetPointCount())]
+    logger.info("get_raster_footprint : {} : {} vertices".format(os.path.basename(raster),
+                                                                 len(coordinates)))
+    return [coordinates]
+
+
+def get_product_footprint(prod_dir, layers=FOOTPRINT_LAYERS, max_size=1024):
+    '''
+        Footprint of the first of layers found in prod_dir (its COG when
+        there is one, as the overviews make the decimated read cheap), or
+        None if there is no such layer or no valid data.
+    '''
+    for layer in layers:
+        for path in (os.path.join(prod_dir, layer + '.tif'),
+                     os.path.join(prod_dir, layer + '.vrt'),
+                     os.path.join(prod_dir, layer)):
+            if os.path.exists(path):
+                return get_raster_footprint(path, max_size)
+    return None
@@ -0,0 +1,481 @@
+# Suite of functionalities for indexing the contents of Sentinel-1 SLC granules
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Persistent inventory of Sentinel-1 SLC granules.
+
+Each granule is read once, from a local zip or SAFE directory or from a remote
+zip with HTTP range requests, and what jobs need to know about it is kept in a
+SQLite index:
+
+- from manifest.safe: mission, sensing times, polarisations, IPF version,
+  orbit numbers and pass direction;
+- from the annotation XMLs: the bursts of every swath, with their azimuth
+  time, burst ID, lines, byte offset and lat/lon box;
+- from the zip directory: every member, its kind (annotation, calibration,
+  noise, measurement, ...), swath, polarisation and data offset.
+
+Later lookups (calibration files of a swath, bursts covering an area, ...) are
+index queries instead of zip directory scans. Local entries are re-read when
+the file changes.
+
+Frames of one pass overlap, so a burst can be in two consecutive granules with
+the same azimuth time. plan_granules() keeps the smallest set of granules that
+still holds every burst intersecting the area.
+"""
+import logging
+import os
+import re
+import sqlite3
+import struct
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+
+from burst_subset import bbox_intersects, read_burst_geometry
+from isce_xml import parse_isce_time
+from safe_zip import parse_swath_file
+from transfer import HTTPRangeFile
+
+logger = logging.getLogger('create_ifg')
+
+GRANULE_INDEX = os.environ.get("GRANULE_INDEX", os.path.join(os.path.expanduser("~"), ".cache",
+                                                            "sds-ondemand", "granule_index.sqlite"))
+
+# e.g. S1A_IW_SLC__1SDV_20200511T135117_20200511T135144_032518_03C421_7768
+GRANULE_NAME_RE = re.compile(r'(?P<granule>(?P<mission>S1\w)_IW_SLC__\w+?'
+                             r'_(?P<start_time>\d{8}T\d{6})_(?P<stop_time>\d{8}T\d{6})'
+                             r'_(?P<absolute_orbit>\d{6})_(?P<datatake>\w{6})_(?P<crc>\w{4}))')
+
+TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+GRANULE_COLUMNS = (('granule', 'TEXT PRIMARY KEY'), ('url', 'TEXT'), ('size', 'INTEGER'),
+                   ('indexed_at', 'TEXT'), ('path', 'TEXT'), ('mtime_ns', 'INTEGER'),
+                   ('mission', 'TEXT'), ('start_time', 'TEXT'), ('stop_time', 'TEXT'),
+                   ('polarizations', 'TEXT'), ('ipf_version', 'TEXT'),
+                   ('absolute_orbit', 'INTEGER'), ('relative_orbit', 'INTEGER'),
+                   ('pass_direction', 'TEXT'), ('local_size', 'INTEGER'))
+BURST_COLUMNS = (('granule', 'TEXT'), ('swath', 'INTEGER'), ('burst_index', 'INTEGER'),
+                 ('azimuth_time', 'TEXT'), ('first_line', 'INTEGER'), ('lines', 'INTEGER'),
+                 ('byte_offset', 'INTEGER'), ('min_lat', 'REAL'), ('max_lat', 'REAL'),
+                 ('min_lon', 'REAL'), ('max_lon', 'REAL'), ('burst_id', 'TEXT'))
+MEMBER_COLUMNS = (('granule', 'TEXT'), ('name', 'TEXT'), ('kind', 'TEXT'), ('swath', 'INTEGER'),
+                  ('polarization', 'TEXT'), ('size', 'INTEGER'), ('compressed', 'INTEGER'),
+                  ('data_offset', 'INTEGER'))
+
+
+@lru_cache(maxsize=4096)
+def parse_granule_name(name):
+    '''
+        Return (granule ID, mission, start time, stop time) of an SLC name,
+        path or URL.
+    '''
+    match = GRANULE_NAME_RE.search(name)
+    if not match:
+        raise RuntimeError("Failed to recognize SLC ID %s." % name)
+    return (match.group('granule'), match.group('mission'),
+            datetime.strptime(match.group('start_time'), TIME_FORMAT),
+            datetime.strptime(match.group('stop_time'), TIME_FORMAT))
+
+
+def get_burst_key(swath, azimuth_time):
+    '''
+        Identity of a burst across granules: its swath and azimuth time to the
+        second (bursts of a swath are ~2.8 s apart).
+    '''
+    seconds = (parse_isce_time(azimuth_time) - datetime(1970, 1, 1)).total_seconds()
+    return swath, int(round(seconds))
+
+
+def get_member_kind(name):
+    '''Kind of a SAFE member: manifest, annotation, calibration, noise, rfi, measurement, other.'''
+    parts = name.split('/')
+    base = parts[-1]
+    if base == 'manifest.safe':
+        return 'manifest'
+    if 'measurement' in parts:
+        return 'measurement'
+    if 'annotation' in parts:
+        if 'calibration' in parts:
+            return 'noise' if base.startswith('noise-') else 'calibration'
+        return 'rfi' if 'rfi' in parts else 'annotation'
+    return 'other'
+
+
+def parse_manifest(manifest):
+    '''
+        Mission, sensing times, polarisations, IPF version, orbit numbers and
+        pass direction from the bytes of a manifest.safe.
+    '''
+    info = {'polarizations': []}
+    family = number = None
+    for elem in ET.fromstring(manifest).iter():
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag == 'familyName' and elem.text and elem.text.startswith('SENTINEL'):
+            family = elem.text
+        elif tag == 'number' and family and number is None:
+            number = elem.text
+        elif tag == 'startTime' and 'start_time' not in info:
+            info['start_time'] = parse_isce_time(elem.text)
+        elif tag == 'stopTime' and 'stop_time' not in info:
+            info['stop_time'] = parse_isce_time(elem.text)
+        elif tag == 'transmitterReceiverPolarisation':
+            info['polarizations'].append(elem.text.lower())
+        elif tag == 'software' and 'ipf_version' not in info:
+            info['ipf_version'] = elem.get('version')
+        elif tag == 'orbitNumber' and elem.get('type') == 'start':
+            info['absolute_orbit'] = int(elem.text)
+        elif tag == 'relativeOrbitNumber' and elem.get('type') == 'start':
+            info['relative_orbit'] = int(elem.text)
+        elif tag == 'pass':
+            info['pass_direction'] = elem.text
+    if family is not None and number is not None:
+        info['mission'] = 'S1' + number
+    return info
+
+
+def get_local_stamp(path):
+    '''
+        (mtime_ns, size) telling whether the local SLC at path changed: those of
+        the zip, or of the manifest.safe of a SAFE directory, as the mtime of
+        the directory itself does not change when files below it are rewritten.
+    '''
+    manifest = os.path.join(path, 'manifest.safe')
+    if os.path.isdir(path) and os.path.exists(manifest):
+        path = manifest
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class GranuleIndex:
+    """SQLite inventory of SLC granules: manifest metadata, bursts and zip members."""
+
+    def __init__(self, db_file=GRANULE_INDEX):
+        self.db_file = db_file
+        directory = os.path.dirname(os.path.abspath(db_file))
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as db:
+            for table, columns, key in (('granules', GRANULE_COLUMNS, None),
+                                        ('bursts', BURST_COLUMNS, 'granule, swath, burst_index'),
+                                        ('members', MEMBER_COLUMNS, 'granule, name')):
+                db.execute('CREATE TABLE IF NOT EXISTS {} ({}{})'.format(
+                    table, ', '.join(' '.join(column) for column in columns),
+                    ', PRIMARY KEY ({})'.format(key) if key else ''))
+                # indexes written before a column was added get it empty
+                present = set(row[1] for row in db.execute('PRAGMA table_info({})'.format(table)))
+                for name, decl in columns:
+                    if name not in present:
+                        db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, decl))
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.db_file, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def has(self, granule):
+        with self._db() as db:
+            row = db.execute('SELECT 1 FROM granules WHERE granule = ?', (granule,)).fetchone()
+        return row is not None
+
+    def is_current(self, granule, path):
+        '''True if granule was indexed from the local path as it is now.'''
+        with self._db() as db:
+            row = db.execute('SELECT path, mtime_ns, local_size FROM granules WHERE granule = ?',
+                             (granule,)).fetchone()
+        return (row is not None and row[0] == os.path.abspath(path) and
+                tuple(row[1:]) == get_local_stamp(path))
+
+    def add(self, granule, size, bursts, info=None, members=None, url=None, path=None):
+        '''
+            Store a granule: its bursts {swath: [read_burst_geometry() dict,
+            ...]}, the parse_manifest() info and the members (dicts with the
+            MEMBER_COLUMNS), read from url or the local path.
+        '''
+        info = info or {}
+        row = {'granule': granule, 'size': size, 'indexed_at': datetime.utcnow().isoformat(),
+               'mtime_ns': None, 'local_size': None, 'url': url, 'path': None}
+        if path is not None:
+            row['path'] = os.path.abspath(path)
+            row['mtime_ns'], row['local_size'] = get_local_stamp(path)
+        for key in ('mission', 'ipf_version', 'absolute_orbit', 'relative_orbit',
+                    'pass_direction'):
+            row[key] = info.get(key)
+        for key in ('start_time', 'stop_time'):
+            row[key] = info[key].isoformat() if key in info else None
+        row['polarizations'] = ','.join(info.get('polarizations', [])) or None
+
+        burst_rows = [(granule, swath, burst['index'], burst['azimuth_time'],
+                       burst['first_line'], burst['lines'], burst['byte_offset'])
+                      + tuple(burst['bbox']) + (burst.get('burst_id'),)
+                      for swath, swath_bursts in bursts.items() for burst in swath_bursts]
+        member_rows = [tuple([granule] + [member[name] for name, _ in MEMBER_COLUMNS[1:]])
+                       for member in members or []]
+        with self._db() as db:
+            previous = db.execute('SELECT url FROM granules WHERE granule = ?',
+                                  (granule,)).fetchone()
+            if row['url'] is None and previous is not None:
+                # a local copy does not make the remote one go away
+                row['url'] = previous[0]
+            db.execute('DELETE FROM bursts WHERE granule = ?', (granule,))
+            db.execute('DELETE FROM members WHERE granule = ?', (granule,))
+            db.executemany('INSERT INTO bursts ({}) VALUES ({})'.format(
+                ', '.join(name for name, _ in BURST_COLUMNS),
+                ', '.join('?' * len(BURST_COLUMNS))), burst_rows)
+            db.executemany('INSERT INTO members ({}) VALUES ({})'.format(
+                ', '.join(name for name, _ in MEMBER_COLUMNS),
+                ', '.join('?' * len(MEMBER_COLUMNS))), member_rows)
+            db.execute('INSERT OR REPLACE INTO granules ({}) VALUES ({})'.format(
+                ', '.join(row), ', '.join('?' * len(row))), list(row.values()))
+        return len(burst_rows)
+
+    def get_granule(self, granule):
+        '''
+            The indexed metadata of granule as a dict, with the swaths and
+            their burst counts, or None if it is not indexed.
+        '''
+        names = [name for name, _ in GRANULE_COLUMNS]
+        with self._db() as db:
+            row = db.execute('SELECT {} FROM granules WHERE granule = ?'.format(', '.join(names)),
+                             (granule,)).fetchone()
+            counts = db.execute('SELECT swath, COUNT(*) FROM bursts WHERE granule = ? '
+                                'GROUP BY swath ORDER BY swath', (granule,)).fetchall()
+        if row is None:
+            return None
+        info = dict(zip(names, row))
+        for key in ('start_time', 'stop_time'):
+            if info[key] is not None:
+                info[key] = datetime.fromisoformat(info[key])
+        info['polarizations'] = info['polarizations'].split(',') if info['polarizations'] else []
+        info['bursts_per_swath'] = dict(counts)
+        info['swaths'] = sorted(info['bursts_per_swath'])
+        return info
+
+    def get_bursts(self, granule):
+        '''Bursts of a granule as {swath: [dict, ...]}, in burst order.'''
+        names = [name for name, _ in BURST_COLUMNS[1:]]
+        with self._db() as db:
+            rows = db.execute('SELECT {} FROM bursts WHERE granule = ? '
+                              'ORDER BY swath, burst_index'.format(', '.join(names)),
+                              (granule,)).fetchall()
+        bursts = {}
+        for row in rows:
+            burst = dict(zip(names, row))
+            burst['bbox'] = tuple(burst.pop(k) for k in ('min_lat', 'max_lat', 'min_lon', 'max_lon'))
+            bursts.setdefault(burst.pop('swath'), []).append(burst)
+        return bursts
+
+    def get_footprint(self, granule):
+        '''(min_lat, max_lat, min_lon, max_lon) of all the bursts of a granule.'''
+        with self._db() as db:
+            row = db.execute('SELECT MIN(min_lat), MAX(max_lat), MIN(min_lon), MAX(max_lon) '
+                             'FROM bursts WHERE granule = ?', (granule,)).fetchone()
+        return None if row[0] is None else row
+
+    def get_members(self, granule, kind=None, swath=None, polarization=None):
+        '''Members of a granule (dicts with the MEMBER_COLUMNS), filtered, by name.'''
+        names = [name for name, _ in MEMBER_COLUMNS[1:]]
+        query = 'SELECT {} FROM members WHERE granule = ?'.format(', '.join(names))
+        args = [granule]
+        for column, value in (('kind', kind), ('swath', swath),
+                              ('polarization', polarization.lower() if polarization else None)):
+            if value is not None:
+                query += ' AND {} = ?'.format(column)
+                args.append(value)
+        with self._db() as db:
+            rows = db.execute(query + ' ORDER BY name', args).fetchall()
+        return [dict(zip(names, row)) for row in rows]
+
+
+def read_zip_granule(zf, read_range, data_offsets=True):
+    '''
+        Read a granule from an open SAFE zip: returns (info, bursts, members).
+        The annotation of one polarisation per swath is parsed (they share the
+        geometry). read_range(offset, length) reads the archive bytes used to
+        find where member data starts; with data_offsets=False that is only
+        done for the uncompressed measurements.
+    '''
+    members = []
+    annotations = {}
+    manifest = None
+    for zinfo in sorted(zf.infolist(), key=lambda zinfo: zinfo.filename):
+        name = zinfo.filename
+        if name.endswith('/'):
+            continue
+        kind = get_member_kind(name)
+        swath_pol = parse_swath_file(name) or (None, None)
+        compressed = zinfo.compress_type != zipfile.ZIP_STORED
+        data_offset = None
+        if data_offsets or not compressed:
+            # local file header: 30 bytes, then the name and extra field
+            header = read_range(zinfo.header_offset, 30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            data_offset = zinfo.header_offset + 30 + name_len + extra_len
+        members.append({'name': name, 'kind': kind, 'swath': swath_pol[0],
+                        'polarization': swath_pol[1], 'size': zinfo.file_size,
+                        'compressed': int(compressed), 'data_offset': data_offset})
+        if kind == 'manifest':
+            manifest = zf.read(name)
+        elif kind == 'annotation' and swath_pol[0] is not None:
+            annotations.setdefault(swath_pol[0], name)
+    info = parse_manifest(manifest) if manifest is not None else {}
+    bursts = {swath: read_burst_geometry(zf.read(name)) for swath, name in annotations.items()}
+    return info, bursts, members
+
+
+def read_safe_granule(safe_dir):
+    '''Read a granule from an unpacked SAFE directory: returns (info, bursts, members).'''
+    parent = os.path.dirname(os.path.abspath(safe_dir))
+    members = []
+    annotations = {}
+    info = {}
+    for dirpath, _, filenames in os.walk(safe_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, parent).replace(os.sep, '/')
+            kind = get_member_kind(name)
+            swath_pol = parse_swath_file(name) or (None, None)
+            members.append({'name': name, 'kind': kind, 'swath': swath_pol[0],
+                            'polarization': swath_pol[1], 'size': os.path.getsize(path),
+                            'compressed': 0, 'data_offset': 0})
+            if kind == 'manifest':
+                with open(path, 'rb') as f:
+                    info = parse_manifest(f.read())
+            elif kind == 'annotation' and swath_pol[0] is not None:
+                annotations.setdefault(swath_pol[0], []).append(path)
+    bursts = {}
+    for swath, paths in annotations.items():
+        with open(sorted(paths)[0], 'rb') as f:
+            bursts[swath] = read_burst_geometry(f.read())
+    return info, bursts, sorted(members, key=lambda member: member['name'])
+
+
+def index_local_granule(index, path):
+    '''
+        Make sure the local SLC zip or SAFE directory at path is indexed as it
+        is now; reads it only when it is new or changed. Returns the granule ID.
+    '''
+    granule = parse_granule_name(os.path.basename(os.path.normpath(path)))[0]
+    if index.is_current(granule, path):
+        return granule
+    if os.path.isdir(path):
+        info, bursts, members = read_safe_granule(path)
+        size = sum(member['size'] for member in members)
+    else:
+        with open(path, 'rb') as f, zipfile.ZipFile(f) as zf:
+            def read_range(offset, length):
+                f.seek(offset)
+                return f.read(length)
+            info, bursts, members = read_zip_granule(zf, read_range)
+        size = os.path.getsize(path)
+    index.add(granule, size, bursts, info, members, path=path)
+    logger.info("index_local_granule : {} : {} bursts in swaths {}, {} members".format(
+        granule, sum(len(b) for b in bursts.values()), sorted(bursts), len(members)))
+    return granule
+
+
+def find_members(index, path, kind, swath=None, polarization=None):
+    '''
+        Paths GDAL can open (/vsizip/ for zips) of the members of the local
+        SLC at path of the given kind, swath and polarization.
+    '''
+    granule = index_local_granule(index, path)
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        prefix = os.path.dirname(path)
+    else:
+        prefix = '/vsizip/' + path
+    return [os.path.join(prefix, member['name'])
+            for member in index.get_members(granule, kind, swath, polarization)]
+
+
+def read_remote_granule(url, client=None):
+    '''
+        Read the remote SLC zip at url with range requests (central
+        directory, manifest and one annotation per swath). Returns (zip size,
+        info, bursts, members, bytes transferred).
+    '''
+    rangefile = HTTPRangeFile(url, client=client)
+    zf = zipfile.ZipFile(rangefile)
+    info, bursts, members = read_zip_granule(zf, rangefile.read_range, data_offsets=False)
+    return rangefile.size, info, bursts, members, rangefile.bytes_read
+
+
+def index_granules(index, granules, url_template, client=None, max_workers=4):
+    '''
+        Add to index the granules it does not hold yet, reading them
+        remotely, several granules at a time.
+    '''
+    missing = [granule for granule in dict.fromkeys(granules) if not index.has(granule)]
+
+    def fetch(granule):
+        url = url_template.format(granule)
+        size, info, bursts, members, nbytes = read_remote_granule(url, client)
+        index.add(granule, size, bursts, info, members, url=url)
+        logger.info("index_granules : {} : {} bursts in swaths {}, read {:.1f} of {:.1f} MB".format(
+            granule, sum(len(b) for b in bursts.values()), sorted(bursts),
+            nbytes / 1024**2, size / 1024**2))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(fetch, missing))
+    return missing
+
+
+def plan_granules(index, granules, bbox, swaths=None, margin=0.05):
+    '''
+        Decide which of the indexed granules are needed for
+        bbox = (min_lat, max_lat, min_lon, max_lon) and the given swaths (None
+        for all). Granules without an intersecting burst are dropped, and so
+        are granules whose intersecting bursts all are in granules kept.
+
+        Returns {'granules': [kept, in input order], 'dropped': {granule:
+        reason}, 'swaths': [swaths with intersecting bursts], 'bursts':
+        {granule: {swath: [burst indices]}}}.
+    '''
+    aoi = (bbox[0] - margin, bbox[1] + margin, bbox[2] - margin, bbox[3] + margin)
+    granules = list(dict.fromkeys(granules))
+    selected = {}
+    keys = {}
+    dropped = {}
+    for granule in granules:
+        bursts = index.get_bursts(granule)
+        if not bursts:
+            raise RuntimeError("Granule {} is not indexed".format(granule))
+        selected[granule] = {}
+        keys[granule] = set()
+        for swath, swath_bursts in bursts.items():
+            if swaths is not None and swath not in swaths:
+                continue
+            hits = [burst for burst in swath_bursts if bbox_intersects(burst['bbox'], aoi)]
+            if hits:
+                selected[granule][swath] = [burst['burst_index'] for burst in hits]
+                keys[granule].update(get_burst_key(swath, burst['azimuth_time'])
+                                     for burst in hits)
+        if not keys[granule]:
+            dropped[granule] = "no burst intersects the AOI"
+
+    # greedy cover: granules holding the most still-uncovered bursts first
+    covered = set()
+    kept = set()
+    candidates = [granule for granule in granules if keys[granule]]
+    while candidates:
+        granule = max(candidates, key=lambda g: len(keys[g] - covered))
+        candidates.remove(granule)
+        if keys[granule] - covered:
+            kept.add(granule)
+            covered |= keys[granule]
+        else:
+            dropped[granule] = "bursts covered by other granules"
+
+    plan = {'granules': [granule for granule in granules if granule in kept],
+            'dropped': dropped,
+            'swaths': sorted(set(swath for granule in kept for swath in selected[granule])),
+            'bursts': {granule: selected[granule] for granule in granules if granule in kept}}
+    return plan
@@ -0,0 +1,63 @@
+# Suite of functionalities for reading ISCE product XML metadata
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Read selected properties of ISCE product XMLs without loading the product.
+
+ISCE products (e.g. ``reference/IW1.xml``) are nested ``component`` elements
+holding ``property`` elements, each with a ``value`` child:
+
+    <component name="burst1">
+        <property name="sensingstart">
+            <value>2019-06-28 01:49:10.123456</value>
+
+Loading them through ProductManager instantiates every component, which
+takes seconds per swath. Here the file is streamed with iterparse and only the
+requested properties are kept. Results are memoised by path and mtime.
+"""
+import os
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1024)
+def _read_xml_properties(path, mtime_ns, names):
+    values = {name: [] for name in names}
+    for _, elem in ET.iterparse(path, events=('end',)):
+        if elem.tag != 'property':
+            continue
+        name = (elem.get('name') or '').lower()
+        if name in values:
+            value = elem.find('value')
+            values[name].append((value if value is not None else elem).text.strip())
+        elem.clear()
+    return {name: tuple(found) for name, found in values.items()}
+
+
+def read_xml_properties(xml_file, names):
+    '''
+        Values (as text, in document order) of the properties called names
+        (case insensitive) anywhere in an ISCE XML: {name: (value, ...)}.
+    '''
+    path = os.path.abspath(xml_file)
+    names = tuple(sorted(set(name.lower() for name in names)))
+    return _read_xml_properties(path, os.stat(path).st_mtime_ns, names)
+
+
+def parse_isce_time(value):
+    '''ISCE writes datetimes with str(), e.g. "2019-06-28 01:49:10.123456".'''
+    value = value.replace('T', ' ')
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def read_sensing_times(xml_file):
+    '''(first sensing start, last sensing stop) over the bursts of a swath product.'''
+    values = read_xml_properties(xml_file, ('sensingstart', 'sensingstop'))
+    if not values['sensingstart'] or not values['sensingstop']:
+        raise RuntimeError("No sensing times in {}".format(xml_file))
+    return (min(parse_isce_time(v) for v in values['sensingstart']),
+            max(parse_isce_time(v) for v in values['sensingstop']))
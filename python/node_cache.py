@@ -0,0 +1,190 @@
+# Suite of functionalities for node-local caching of input datasets
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Node-local cache shared by all PGEs running on one host.
+
+Entries are files or directories stored under ``<root>/objects/<key>``, where
+the key identifies the content (e.g. an SLC granule ID). A small SQLite index
+records the size and last use of every entry and is used for size-bounded LRU
+eviction. Filling an entry holds an exclusive ``flock`` on a per-key lock
+file, so concurrent jobs asking for the same key wait for a single download
+instead of fetching it twice. Jobs get their own hard links to the files of an
+entry (copies when the job directory is on another filesystem), made under the
+key lock, so evicting an entry never pulls files from under a job still using
+them.
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('create_ifg')
+
+GB = 1024 ** 3
+
+
+def get_size(path):
+    '''Size in bytes of a file or of all files below a directory.'''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            fpath = os.path.join(dirpath, name)
+            if not os.path.islink(fpath):
+                size += os.path.getsize(fpath)
+    return size
+
+
+def link_file(src, dest):
+    '''Hard link src at dest, copying it when a link is not possible.'''
+    try:
+        os.link(src, dest)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dest)
+    return dest
+
+
+class NodeCache:
+    """Size-bounded, LRU-evicted cache of files/directories keyed by content ID."""
+
+    def __init__(self, root, max_bytes=200 * GB):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.locks_dir = os.path.join(self.root, 'locks')
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        for directory in (self.objects_dir, self.locks_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.index_file = os.path.join(self.root, 'index.sqlite')
+        with self._db() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'key TEXT PRIMARY KEY, size INTEGER, '
+                       'created REAL, last_used REAL)')
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.index_file, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _lock(self, name, exclusive=True, blocking=True):
+        lock_file = os.path.join(self.locks_dir, '{}.lock'.format(name))
+        with open(lock_file, 'a') as fd:
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            fcntl.flock(fd, flags)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def path(self, key):
+        return os.path.join(self.objects_dir, key)
+
+    def tmp_path(self, key):
+        '''Stable staging path for ``key``, so interrupted fills can resume.'''
+        return os.path.join(self.tmp_dir, key)
+
+    def _touch(self, key):
+        with self._db() as db:
+            db.execute('UPDATE entries SET last_used = ? WHERE key = ?',
+                       (time.time(), key))
+
+    def get(self, key):
+        '''Return the cached path for ``key`` or None on a miss.'''
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        self._touch(key)
+        return path
+
+    def fetch(self, key, fill, dest=None):
+        '''
+            Return the cached path for ``key``, calling ``fill(tmp_path)`` to
+            create it on a miss. ``fill`` must write the file or directory at
+            ``tmp_path``; it is moved into the cache once it returns. With
+            ``dest``, the entry is also linked there (see link) before the key
+            lock is released, so it cannot be evicted in between.
+        '''
+        path = self.path(key)
+        with self._lock(key):
+            if os.path.exists(path):
+                logger.info("NodeCache hit : {}".format(key))
+                self._touch(key)
+            else:
+                logger.info("NodeCache miss : {}".format(key))
+                tmp_path = self.tmp_path(key)
+                fill(tmp_path)
+                os.replace(tmp_path, path)
+                now = time.time()
+                with self._db() as db:
+                    db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                               (key, get_size(path), now, now))
+            if dest is not None:
+                self._link(path, dest)
+        self.evict(keep=key)
+        return path
+
+    def link(self, key, dest):
+        '''
+            Expose the cached entry ``key`` at ``dest``: a hard link to the
+            file, or a directory tree of hard links, falling back to copies
+            across filesystems. The job keeps its files if the entry is evicted.
+        '''
+        with self._lock(key, exclusive=False):
+            path = self.get(key)
+            if path is None:
+                raise KeyError(key)
+            return self._link(path, dest)
+
+    def _link(self, path, dest):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            os.remove(dest)
+        if os.path.isdir(path):
+            shutil.copytree(path, dest, copy_function=link_file)
+        else:
+            link_file(path, dest)
+        return dest
+
+    def evict(self, keep=None):
+        '''Remove least recently used entries until the cache fits ``max_bytes``.'''
+        with self._lock('.evict'):
+            with self._db() as db:
+                rows = db.execute('SELECT key, size FROM entries '
+                                  'ORDER BY last_used ASC').fetchall()
+            total = sum(size for _, size in rows)
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                try:
+                    # skip entries that another job is filling or linking right now
+                    with self._lock(key, blocking=False):
+                        path = self.path(key)
+                        if os.path.isdir(path) and not os.path.islink(path):
+                            shutil.rmtree(path)
+                        elif os.path.lexists(path):
+                            os.remove(path)
+                        with self._db() as db:
+                            db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                except BlockingIOError:
+                    continue
+                logger.info("NodeCache evicted : {} ({} bytes)".format(key, size))
+                total -= size
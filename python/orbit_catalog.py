@@ -0,0 +1,116 @@
+# Suite of functionalities for indexing Sentinel-1 orbit files
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Persistent catalog of Sentinel-1 orbit (EOF) files.
+
+Orbit file names carry the mission, orbit type and validity window, e.g.
+``S1B_OPER_AUX_POEORB_OPOD_20190718T110611_V20190627T225942_20190629T005942``.
+The catalog keeps these in a SQLite table so that the orbits covering an
+acquisition are found with an interval query, and records which listing pages
+(mission, orbit type, day) were already harvested so that the QC server is
+only scraped for days never seen before.
+"""
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+ORBIT_NAME_RE = re.compile(r'(?P<mission>S1\w)_OPER_AUX_(?P<type>\w+?)_OPOD_'
+                           r'(?P<production>\d{8}T\d{6})_'
+                           r'V(?P<start>\d{8}T\d{6})_(?P<stop>\d{8}T\d{6})')
+
+TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+# days after which a listing page is complete: precise orbits are published
+# about three weeks after acquisition, restituted ones within hours
+SETTLE_DAYS = {'aux_poeorb': 21, 'aux_resorb': 1}
+
+
+def parse_orbit_name(name):
+    '''
+        Return (mission, orbit_type, validity_start, validity_stop) of an orbit
+        file name, orbit_type being the QC server listing name ("aux_poeorb").
+    '''
+    match = ORBIT_NAME_RE.search(name)
+    if not match:
+        raise RuntimeError("Failed to parse orbit: {}".format(name))
+    return (match.group('mission'),
+            'aux_{}'.format(match.group('type').lower()),
+            datetime.strptime(match.group('start'), TIME_FORMAT),
+            datetime.strptime(match.group('stop'), TIME_FORMAT))
+
+
+class OrbitCatalog:
+    """SQLite index of orbit files and of the listing pages already harvested."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        directory = os.path.dirname(os.path.abspath(db_file))
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS orbits ('
+                       'name TEXT PRIMARY KEY, mission TEXT, orbit_type TEXT, '
+                       'validity_start TEXT, validity_stop TEXT, url TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS orbits_validity ON orbits '
+                       '(mission, orbit_type, validity_start, validity_stop)')
+            db.execute('CREATE TABLE IF NOT EXISTS scanned ('
+                       'mission TEXT, orbit_type TEXT, day TEXT, scanned_at TEXT, '
+                       'PRIMARY KEY (mission, orbit_type, day))')
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.db_file, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, orbits):
+        '''Insert (name, url) pairs; names already present are updated.'''
+        rows = []
+        for name, url in orbits:
+            mission, orbit_type, start, stop = parse_orbit_name(name)
+            rows.append((name, mission, orbit_type,
+                         start.isoformat(), stop.isoformat(), url))
+        with self._db() as db:
+            db.executemany('INSERT OR REPLACE INTO orbits VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def is_scanned(self, mission, orbit_type, day):
+        '''
+            True if the listing page of ``day`` (YYYY-MM-DD) was harvested late
+            enough to be complete.
+        '''
+        with self._db() as db:
+            row = db.execute('SELECT scanned_at FROM scanned WHERE mission = ? '
+                             'AND orbit_type = ? AND day = ?',
+                             (mission, orbit_type, day)).fetchone()
+        if row is None:
+            return False
+        settle = timedelta(days=SETTLE_DAYS.get(orbit_type, 0))
+        return datetime.fromisoformat(row[0]) >= datetime.strptime(day, '%Y-%m-%d') + settle
+
+    def mark_scanned(self, mission, orbit_type, day):
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO scanned VALUES (?, ?, ?, ?)',
+                       (mission, orbit_type, day, datetime.utcnow().isoformat()))
+
+    def lookup(self, mission, orbit_type, start, stop):
+        '''
+            Orbits of ``orbit_type`` whose validity window covers [start, stop],
+            as (name, url, validity_start, validity_stop) tuples sorted by most
+            recent production.
+        '''
+        with self._db() as db:
+            rows = db.execute('SELECT name, url, validity_start, validity_stop FROM orbits '
+                              'WHERE mission = ? AND orbit_type = ? '
+                              'AND validity_start <= ? AND validity_stop >= ? '
+                              'ORDER BY name DESC',
+                              (mission, orbit_type, start.isoformat(),
+                               stop.isoformat())).fetchall()
+        return [(name, url, datetime.fromisoformat(vstart), datetime.fromisoformat(vstop))
+                for name, url, vstart, vstop in rows]
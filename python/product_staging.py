@@ -0,0 +1,113 @@
+# Suite of functionalities for staging product files without extra copies
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Assemble product directories from processing outputs.
+
+Files are put in place with the cheapest operation the filesystem allows:
+a rename (when the source may be consumed), a hard link, a reflink (copy on
+write clone, e.g. on XFS or btrfs) and only then a byte copy, which is what
+happens across devices. The checksum of every file is computed in the same
+pass: while copying, or with a single read of the linked file otherwise.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('create_ifg')
+
+MB = 1024 * 1024
+
+# ioctl request of FICLONE (linux/fs.h)
+FICLONE = 0x40049409
+
+# errors meaning "this operation is not possible here", not "this file is bad"
+FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+                   errno.ENOTTY, errno.EINVAL)
+
+
+def hash_file(path, algorithm='md5', block_size=8 * MB):
+    '''Hex digest of a file.'''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reflink(src, dest):
+    '''Clone src to dest sharing its extents; raises OSError where unsupported.'''
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdest.close()
+            os.remove(dest)
+            raise
+
+
+def copy_with_checksum(src, dest, algorithm='md5', block_size=8 * MB):
+    '''Copy src to dest, hashing the bytes on the way. Returns the hex digest.'''
+    digest = hashlib.new(algorithm)
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        for block in iter(lambda: fsrc.read(block_size), b''):
+            digest.update(block)
+            fdest.write(block)
+    os.utime(dest, ns=(os.stat(src).st_atime_ns, os.stat(src).st_mtime_ns))
+    return digest.hexdigest()
+
+
+def stage_file(src, dest, move=False, algorithm='md5'):
+    '''
+        Put src at dest by rename (move=True), hard link or reflink, copying
+        only when none of these is possible. Returns (method, hex digest).
+    '''
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if move:
+        try:
+            os.replace(src, dest)
+            return 'rename', hash_file(dest, algorithm)
+        except OSError as err:
+            if err.errno not in FALLBACK_ERRNOS:
+                raise
+    for method, func in (('link', os.link), ('reflink', reflink)):
+        try:
+            func(src, dest)
+            return method, hash_file(dest, algorithm)
+        except OSError as err:
+            if err.errno not in FALLBACK_ERRNOS:
+                raise
+    checksum = copy_with_checksum(src, dest, algorithm)
+    if move:
+        os.remove(src)
+    return 'copy', checksum
+
+
+def stage_files(sources, dest_dir, move=False, algorithm='md5', max_workers=4):
+    '''
+        Stage files into dest_dir with stage_file, several at a time. Returns
+        {file name: {'size', 'method', <algorithm>}}.
+    '''
+    os.makedirs(dest_dir, exist_ok=True)
+
+    def stage(src):
+        name = os.path.basename(src)
+        method, checksum = stage_file(src, os.path.join(dest_dir, name), move, algorithm)
+        return name, {'size': os.path.getsize(os.path.join(dest_dir, name)),
+                      'method': method, algorithm: checksum}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        staged = dict(pool.map(stage, sources))
+
+    methods = {}
+    for entry in staged.values():
+        methods[entry['method']] = methods.get(entry['method'], 0) + 1
+    logger.info("stage_files : {} files, {:.1f} MB into {} ({})".format(
+        len(staged), sum(entry['size'] for entry in staged.values()) / MB, dest_dir,
+        ", ".join("{} {}".format(n, method) for method, n in sorted(methods.items()))))
+    return staged
@@ -18,10 +18,12 @@ import isceobj.Sensor.TOPS as TOPS
 import isceobj.Sensor.TOPS.BurstSLC as BurstSLC
 from isceobj.Image import createImage
 import glob
+import sqlite3
 from osgeo import gdal
 import numpy as np
 from scipy.interpolate import LinearNDInterpolator as interpnd
 from iscesys.Parsers import XmlParser
+from granule_index import GranuleIndex, find_members
 
 def cmdLineParse():
     '''
@@ -95,48 +97,47 @@ read_calibration_slc.py -zip S1A_IW_SLC__1SDV_20150315T231319_20150315T231349_00
 
     return inps
 
+def listCaliFiles(dirname, prefix, swathNumber, polid):
+    # calibration-/noise- XMLs of a swath, listed straight from the zip or SAFE
+    swathid = 's1?-iw%d'%(swathNumber)
+    if dirname.endswith('.zip'):
+        pattern = os.path.join('*SAFE','annotation','calibration',prefix) + swathid + '-slc-' + polid + '*.xml'
+        with zipfile.ZipFile(dirname, 'r') as zf:
+            return ['/vsizip/'+os.path.join(dirname, name) for name in fnmatch.filter(zf.namelist(), pattern)]
+    pattern = os.path.join('annotation','calibration',prefix) + swathid + '-slc-' + polid + '*.xml'
+    return glob.glob(os.path.join(dirname, pattern))
+
 def locateCaliFile(slc,type,polid='vv'):
-    swathid = 's1?-iw%d'%(slc.swathNumber)
-#    polid = slc.polarization  #default is already set to 'vv'
     print('Using data polarization ', polid)
-    match = None
+    # calibration and noise XMLs are looked up in the granule index, which
+    # lists the zip members once instead of scanning every zip per call; the
+    # files are listed directly when the index cannot be used (unwritable
+    # cache directory, SLC not named after its granule ID)
+    try:
+        index = GranuleIndex()
+    except (OSError, sqlite3.Error) as err:
+        print('Granule index unavailable, listing the SLC files: ', err)
+        index = None
+    kind = {'radio': 'calibration', 'noise': 'noise'}[type]
     for dirname in slc.safe:
-        match = None
-        
-        if dirname.endswith('.zip'):
-            zf = zipfile.ZipFile(dirname, 'r')
-            if type == 'radio':
-                pattern = os.path.join('*SAFE','annotation','calibration','calibration-') + swathid + '-slc-' + polid + '*.xml'
-                match = fnmatch.filter(zf.namelist(), pattern)
-                if (len(match) == 0):
-                    raise Exception('No radiometric calibration file found in zip file: {0}'.format(dirname))
-                slc.radioCali.append('/vsizip/'+os.path.join(dirname, match[0]) )
-                print('Found radiometric calibration files: ', slc.radioCali)
-            elif type == 'noise':
-                pattern = os.path.join('*SAFE','annotation','calibration','noise-') + swathid + '-slc-' + polid + '*.xml'
-                zf = zipfile.ZipFile(dirname, 'r')
-                match = fnmatch.filter(zf.namelist(), pattern)
-                if (len(match) == 0):
-                    raise Exception('No noise calibration file found in zip file: {0}'.format(dirname))
-                slc.noiseCali.append('/vsizip/'+os.path.join(dirname, match[0]) )
-                print('Found noise calibration files: ', slc.noiseCali)
-            zf.close()
-        
-        else:
-            if type == 'radio':
-                pattern = os.path.join('annotation','calibration','calibration-') + swathid + '-slc-' + polid + '*.xml'
-                match = glob.glob( os.path.join(dirname, pattern))
-                if (len(match) == 0):
-                    raise Exception('No radiometric calibration file found in {0}'.format(dirname))
-                slc.radioCali.append(match[0])
-                print('Found radiometric calibration files: ', slc.radioCali)
-            elif type == 'noise':
-                pattern = os.path.join('annotation','calibration','noise-') + swathid + '-slc-' + polid + '*.xml'
-                match = glob.glob( os.path.join(dirname, pattern))
-                if (len(match) == 0):
-                    raise Exception('No noise calibration file found in {0}'.format(dirname))
-                slc.noiseCali.append(match[0])
-                print('Found noise calibration files: ', slc.noiseCali)
+        match = []
+        if index is not None:
+            try:
+                match = find_members(index, dirname, kind, slc.swathNumber, polid)
+            except (RuntimeError, OSError, sqlite3.Error, zipfile.BadZipFile) as err:
+                print('Granule index lookup failed for {0}, listing its files: '.format(dirname), err)
+        if len(match) == 0:
+            match = listCaliFiles(dirname, kind + '-', slc.swathNumber, polid)
+        if type == 'radio':
+            if (len(match) == 0):
+                raise Exception('No radiometric calibration file found in {0}'.format(dirname))
+            slc.radioCali.append(match[0])
+            print('Found radiometric calibration files: ', slc.radioCali)
+        elif type == 'noise':
+            if (len(match) == 0):
+                raise Exception('No noise calibration file found in {0}'.format(dirname))
+            slc.noiseCali.append(match[0])
+            print('Found noise calibration files: ', slc.noiseCali)
 
 def sort_caliFiles(slc):
     if len(slc._tiffSrc)>0:
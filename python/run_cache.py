@@ -0,0 +1,134 @@
+# Suite of functionalities for reusing the results of identical topsApp runs
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Cache of finished topsApp runs keyed by a hash of what determines them.
+
+The key of a run is the SHA-256 of a canonical JSON document holding the
+normalised topsApp properties (names lower-cased and whitespace-collapsed,
+values parsed so that "7", 7 and 7.0 or "[1, 2]" and [1, 2] compare equal),
+the reference and secondary granule IDs, the area of interest, the last
+processing step, the versions of the software involved and the kind of result
+cached ("product" for published products, "workdir" for topsApp work
+directories), so that different kinds of results never share a key. A SQLite table maps
+keys to the directories holding the results, so a resubmitted job can return
+the existing product instead of processing again. Entries whose directory was
+removed are dropped on lookup.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+from granule_index import parse_granule_name
+
+logger = logging.getLogger('create_ifg')
+
+RUN_CACHE = os.environ.get("RUN_CACHE", os.path.join(os.path.expanduser("~"), ".cache",
+                                                    "sds-ondemand", "run_cache.sqlite"))
+
+
+def normalize_value(value):
+    '''Canonical form of a property value, so equivalent spellings hash alike.'''
+    if isinstance(value, str):
+        text = value.strip()
+        if text.lower() in ('true', 'false'):
+            return text.lower() == 'true'
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return text
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, dict):
+        return normalize_properties(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def normalize_properties(properties):
+    '''topsApp properties with normalised names and values.'''
+    return {' '.join(str(name).lower().split()): normalize_value(value)
+            for name, value in properties.items()}
+
+
+def get_software_versions(extra=None):
+    '''Versions of ISCE and GDAL (when importable), plus the extra ones given.'''
+    versions = {}
+    try:
+        import isce
+        versions['isce'] = getattr(isce, '__version__', None)
+    except ImportError:
+        versions['isce'] = None
+    try:
+        from osgeo import gdal
+        versions['gdal'] = gdal.__version__
+    except ImportError:
+        versions['gdal'] = None
+    versions.update(extra or {})
+    return versions
+
+
+def get_run_config(tops_properties, reference_slcs, secondary_slcs, bbox=None,
+                   sensor_name="SENTINEL1", end="geocode", versions=None, kind="product"):
+    '''The canonical description of a run that its key is computed from.'''
+    return {'kind': kind,
+            'properties': normalize_properties(tops_properties),
+            'sensor_name': sensor_name,
+            'reference': sorted(parse_granule_name(slc)[0] for slc in reference_slcs),
+            'secondary': sorted(parse_granule_name(slc)[0] for slc in secondary_slcs),
+            'bbox': [normalize_value(v) for v in bbox] if bbox is not None else None,
+            'end': end,
+            'versions': versions if versions is not None else get_software_versions()}
+
+
+def get_run_key(config):
+    '''SHA-256 hex digest of a get_run_config() document.'''
+    canonical = json.dumps(config, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class RunCache:
+    """SQLite map of run keys to the directories holding their results."""
+
+    def __init__(self, db_file=RUN_CACHE):
+        self.db_file = db_file
+        directory = os.path.dirname(os.path.abspath(db_file))
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                       'key TEXT PRIMARY KEY, product_dir TEXT, config TEXT, created_at TEXT)')
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.db_file, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def lookup(self, key):
+        '''Directory of the results of run key, or None.'''
+        with self._db() as db:
+            row = db.execute('SELECT product_dir FROM runs WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isdir(row[0]):
+                logger.info("RunCache : {} is gone, dropping run {}".format(row[0], key))
+                db.execute('DELETE FROM runs WHERE key = ?', (key,))
+                return None
+        return row[0]
+
+    def record(self, key, product_dir, config=None):
+        '''Remember that the results of run key are in product_dir.'''
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                       (key, os.path.abspath(product_dir),
+                        json.dumps(config, sort_keys=True, default=str),
+                        datetime.utcnow().isoformat()))
@@ -0,0 +1,171 @@
+# Suite of functionalities for publishing products to S3
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Upload a finished product directory to S3.
+
+Files are uploaded largest first, several at a time, each as a concurrent
+multipart transfer driven by one shared boto3 TransferConfig. The MD5 of every
+file is stored in the object metadata and the ETag S3 returns is compared with
+the one expected from the local part layout, so corrupted transfers are caught.
+Objects already present with the same size and checksums are skipped, so a
+failed publish resumes with the files it had not finished; the skip is per
+file, a file whose transfer was interrupted is uploaded again from its first
+part. The endpoint can be pointed at a local S3 stand-in (moto, MinIO) with
+S3_ENDPOINT_URL.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3transfer.utils import ChunksizeAdjuster
+
+logger = logging.getLogger('create_ifg')
+
+MB = 1024 * 1024
+
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * MB, multipart_chunksize=64 * MB,
+                                 max_concurrency=8, use_threads=True)
+
+
+def get_s3_client(endpoint_url=None, max_pool_connections=64):
+    '''S3 client for endpoint_url (default: S3_ENDPOINT_URL, else AWS).'''
+    endpoint_url = endpoint_url or os.environ.get('S3_ENDPOINT_URL')
+    return boto3.client('s3', endpoint_url=endpoint_url,
+                        config=Config(max_pool_connections=max_pool_connections))
+
+
+def file_checksums(path, config=TRANSFER_CONFIG, block_size=8 * MB):
+    '''
+        (MD5, expected ETag) of a file, in one read. Multipart uploads get
+        the ETag md5(part digests)-<parts>, with parts laid out as
+        s3transfer lays them out for config.
+    '''
+    size = os.path.getsize(path)
+    multipart = size >= config.multipart_threshold
+    chunksize = ChunksizeAdjuster().adjust_chunksize(config.multipart_chunksize, size)
+    md5 = hashlib.md5()
+    part_digests = []
+    with open(path, 'rb') as f:
+        while True:
+            part = hashlib.md5()
+            remaining = chunksize
+            while remaining:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    break
+                md5.update(block)
+                part.update(block)
+                remaining -= len(block)
+            if remaining == chunksize:
+                break
+            part_digests.append(part.digest())
+            if remaining:
+                break
+    if not multipart:
+        return md5.hexdigest(), md5.hexdigest()
+    etag = "{}-{}".format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+    return md5.hexdigest(), etag
+
+
+def is_published(client, bucket, key, size, md5, etag):
+    '''
+        True if bucket/key already holds this exact file. Parts of an
+        unfinished multipart upload do not count, see upload_file.
+    '''
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return (head['ContentLength'] == size and head['Metadata'].get('md5') == md5 and
+            head['ETag'].strip('"') == etag)
+
+
+def upload_file(client, path, bucket, key, config=TRANSFER_CONFIG):
+    '''
+        Upload one file unless it is already published as a whole. An
+        interrupted upload is not resumed part by part, the file is sent
+        again. Returns a dict with the key, size, md5, seconds and whether it
+        was skipped.
+    '''
+    size = os.path.getsize(path)
+    md5, etag = file_checksums(path, config)
+    result = {'key': key, 'size': size, 'md5': md5, 'skipped': True, 'seconds': 0.0}
+    if is_published(client, bucket, key, size, md5, etag):
+        return result
+
+    t0 = time.time()
+    client.upload_file(path, bucket, key, ExtraArgs={'Metadata': {'md5': md5}}, Config=config)
+    head = client.head_object(Bucket=bucket, Key=key)
+    # SSE-KMS ETags are not MD5 based, the size and metadata still are checked
+    if head['ContentLength'] != size or (head['ETag'].strip('"') != etag and
+                                         head.get('ServerSideEncryption') != 'aws:kms'):
+        raise RuntimeError("Checksum mismatch after uploading {} to s3://{}/{}: "
+                           "ETag {} expected {}".format(path, bucket, key, head['ETag'], etag))
+    result.update(skipped=False, seconds=time.time() - t0)
+    return result
+
+
+def publish_product(prod_dir, bucket, prefix=None, client=None, max_workers=4,
+                    config=TRANSFER_CONFIG):
+    '''
+        Upload every file below prod_dir to s3://bucket/[<prefix>/]<product
+        name>/..., largest files first, max_workers files at a time. Returns
+        the list of per-file results.
+    '''
+    if client is None:
+        client = get_s3_client(max_pool_connections=max_workers * config.max_concurrency)
+    prod_dir = os.path.abspath(prod_dir)
+    base = os.path.basename(prod_dir)
+    if prefix:
+        base = "{}/{}".format(prefix.strip('/'), base)
+
+    files = []
+    for dirpath, _, filenames in os.walk(prod_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            key = "{}/{}".format(base, os.path.relpath(path, prod_dir).replace(os.sep, '/'))
+            files.append((os.path.getsize(path), path, key))
+    # largest first, so the long transfers do not end up alone at the tail
+    files.sort(reverse=True)
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda f: upload_file(client, f[1], bucket, f[2], config),
+                                files))
+    uploaded = [r for r in results if not r['skipped']]
+    logger.info("publish_product : s3://{}/{} : {} files uploaded ({:.1f} MB), {} already "
+                "published, in {:.1f} s".format(bucket, base, len(uploaded),
+                                                sum(r['size'] for r in uploaded) / MB,
+                                                len(results) - len(uploaded), time.time() - t0))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Upload product directories to S3, skipping "
+                                                 "the files already published")
+    parser.add_argument('prod_dirs', nargs='+', help='product directories.')
+    parser.add_argument('-b', '--bucket', type=str, required=True, help='destination bucket.')
+    parser.add_argument('-p', '--prefix', type=str, default=None,
+                        help='key prefix the products are published under.')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='number of files uploaded at a time.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format="[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s",
+                        level=logging.INFO)
+    args = parse_args()
+    for prod_dir in args.prod_dirs:
+        publish_product(prod_dir, args.bucket, prefix=args.prefix, max_workers=args.workers)
@@ -0,0 +1,80 @@
+# Suite of functionalities for reading Sentinel-1 SAFE zip archives
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Helpers to pick the parts of a Sentinel-1 SAFE zip that a job needs.
+
+A TOPS SLC zip holds one measurement TIFF per (IW swath, polarisation) pair
+plus its annotation, calibration and noise XMLs. topsApp only reads the files
+of the swaths and polarisation it processes, together with manifest.safe, so
+the others do not need to be written to disk.
+"""
+import logging
+import os
+import re
+import zipfile
+
+logger = logging.getLogger('create_ifg')
+
+# e.g. S1A_...SAFE/measurement/s1a-iw3-slc-vv-20200511t135119-...-006.tiff
+#      S1A_...SAFE/annotation/calibration/noise-s1a-iw3-slc-vv-...-006.xml
+SWATH_FILE_RE = re.compile(r's1\w-iw(?P<swath>\d)-slc-(?P<pol>hh|hv|vh|vv)-.*\.(xml|tiff)$',
+                           re.IGNORECASE)
+
+
+def parse_swath_file(name):
+    '''Return (swath, polarization) of a per-swath SAFE member, or None.'''
+    match = SWATH_FILE_RE.search(os.path.basename(name))
+    if not match:
+        return None
+    return int(match.group('swath')), match.group('pol').lower()
+
+
+def select_safe_members(names, swaths=None, polarization=None):
+    '''
+        Filter SAFE member names down to manifest.safe and the annotation,
+        calibration, noise and measurement files of the requested swaths and
+        polarization. None keeps every swath / polarization.
+    '''
+    if swaths is not None:
+        swaths = set(int(swath) for swath in swaths)
+    if polarization is not None:
+        polarization = polarization.lower()
+
+    selected = []
+    for name in names:
+        if name.endswith('/'):
+            continue
+        if os.path.basename(name) == 'manifest.safe':
+            selected.append(name)
+            continue
+        parsed = parse_swath_file(name)
+        if parsed is None:
+            continue
+        swath, pol = parsed
+        if swaths is not None and swath not in swaths:
+            continue
+        if polarization is not None and pol != polarization:
+            continue
+        selected.append(name)
+    return selected
+
+
+def extract_safe(zip_file, out_dir, swaths=None, polarization=None):
+    '''
+        Extract only the members of zip_file selected by select_safe_members
+        into out_dir. Returns the number of bytes written.
+    '''
+    with zipfile.ZipFile(zip_file, 'r') as zf:
+        infos = {info.filename: info for info in zf.infolist()}
+        members = select_safe_members(infos, swaths, polarization)
+        nbytes = 0
+        for name in members:
+            zf.extract(infos[name], out_dir)
+            nbytes += infos[name].file_size
+    total = sum(info.file_size for info in infos.values())
+    logger.info("extract_safe : {} : wrote {} of {} members, {:.1f} of {:.1f} MB".format(
+        os.path.basename(zip_file), len(members), len(infos),
+        nbytes / 1024**2, total / 1024**2))
+    return nbytes
@@ -0,0 +1,96 @@
+import http.server
+import os
+import re
+import socketserver
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of server.root with byte-range support.
+
+    server.behaviour maps a path to the failures and delays to apply to it:
+    'fail' (number of 503 answers before serving), 'fail_start' (range start
+    always answered with 500), 'stall' (seconds to wait once, before the first
+    body of more than one byte) and 'block_delay' (seconds between block_size
+    blocks).
+    """
+    protocol_version = 'HTTP/1.1'
+    block_size = 1024
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        behaviour = server.behaviour.setdefault(self.path, {})
+        path = os.path.join(server.root, self.path.lstrip('/'))
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        with open(path, 'rb') as f:
+            data = f.read()
+        start, end = 0, len(data) - 1
+        ranged = 'Range' in self.headers
+        if ranged:
+            m = re.match(r'bytes=(\d+)-(\d*)', self.headers['Range'])
+            start = int(m.group(1))
+            end = min(int(m.group(2)) if m.group(2) else end, end)
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Range')))
+            if behaviour.get('fail', 0) > 0:
+                behaviour['fail'] -= 1
+                return self._error(503)
+        if ranged and start == behaviour.get('fail_start'):
+            return self._error(500)
+
+        self.send_response(206 if ranged else 200)
+        if ranged:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if end > start:
+            with server.lock:
+                stall = behaviour.pop('stall', 0)
+            time.sleep(stall)
+        try:
+            for offset in range(start, end + 1, self.block_size):
+                self.wfile.write(data[offset:min(offset + self.block_size, end + 1)])
+                time.sleep(behaviour.get('block_delay', 0))
+        except ConnectionError:
+            # the client cancelled the transfer
+            self.close_connection = True
+
+    def _error(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class RangeServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    """Local HTTP server over tmp_path/'srv'; server.url(name) is a file's URL."""
+    root = tmp_path / 'srv'
+    root.mkdir()
+    server = RangeServer(('127.0.0.1', 0), RangeHandler)
+    server.root = str(root)
+    server.behaviour = {}
+    server.requests = []
+    server.lock = threading.Lock()
+    server.url = lambda name: 'http://127.0.0.1:{}/{}'.format(server.server_address[1], name)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+
+import pytest
+
+from transfer import ChunkedDownloader, HedgedDownloader, TransferClient
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+MB = 1024 * 1024
+
+
+class SlowBucket:
+    """A bucket whose downloads pause delay seconds at every progress callback."""
+
+    def __init__(self, bucket, delay):
+        self.bucket = bucket
+        self.name = bucket.name
+        self.delay = delay
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+
+    def download_file(self, key, path, Callback=None):
+        def progress(n):
+            time.sleep(self.delay)
+            try:
+                Callback(n)
+            except RuntimeError:
+                self.cancelled.set()
+                raise
+
+        self.started.set()
+        return self.bucket.download_file(key, path, Callback=progress)
+
+
+@pytest.fixture
+def mirror():
+    with mock_aws():
+        s3 = boto3.resource('s3', region_name='us-east-1')
+        bucket = s3.create_bucket(Bucket='slc-mirror')
+        yield bucket
+
+
+def hedged(bucket, **kwargs):
+    downloader = ChunkedDownloader(chunk_size=64 * 1024, chunks_per_file=1,
+                                   client=TransferClient(retries=0), block_size=1024)
+    return HedgedDownloader(bucket, downloader, min_bytes_per_sec=MB, grace=0.2, window=0.5,
+                            poll=0.1, **kwargs)
+
+
+def test_mirror_wins_over_slow_primary(range_server, mirror, tmp_path):
+    data = os.urandom(256 * 1024)
+    with open(os.path.join(range_server.root, 'a.zip'), 'wb') as f:
+        f.write(data)
+    mirror.put_object(Key='a.zip', Body=data)
+    # 256 blocks of 1 kB, 20 s for the whole file
+    range_server.behaviour['/a.zip'] = {'block_delay': 0.08}
+
+    path = str(tmp_path / 'a.zip')
+    t0 = time.monotonic()
+    result = hedged(mirror).download(range_server.url('a.zip'), 'a.zip', path)
+
+    assert result['source'] == 'mirror'
+    assert result['url'] == 's3://slc-mirror/a.zip'
+    # the primary transfer was cancelled instead of running to its end
+    assert time.monotonic() - t0 < 10
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert sorted(os.listdir(str(tmp_path))) == ['a.zip', 'srv']
+
+
+def test_primary_wins_over_slow_mirror(range_server, mirror, tmp_path):
+    data = os.urandom(2 * MB)
+    with open(os.path.join(range_server.root, 'a.zip'), 'wb') as f:
+        f.write(data)
+    mirror.put_object(Key='a.zip', Body=data)
+    # the primary stalls long enough to start the mirror, then is fast
+    range_server.behaviour['/a.zip'] = {'stall': 1.0}
+    bucket = SlowBucket(mirror, delay=1.0)
+
+    path = str(tmp_path / 'a.zip')
+    result = hedged(bucket).download(range_server.url('a.zip'), 'a.zip', path)
+
+    assert result['source'] == 'primary'
+    assert bucket.started.is_set()
+    assert bucket.cancelled.is_set()
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert sorted(os.listdir(str(tmp_path))) == ['a.zip', 'srv']
+
+
+def test_mirror_after_primary_failure(range_server, mirror, tmp_path):
+    data = os.urandom(100 * 1024)
+    mirror.put_object(Key='a.zip', Body=data)
+
+    path = str(tmp_path / 'a.zip')
+    # not on the primary server: its download fails with a 404
+    result = hedged(mirror).download(range_server.url('a.zip'), 'a.zip', path)
+
+    assert result['source'] == 'mirror'
+    with open(path, 'rb') as f:
+        assert f.read() == data
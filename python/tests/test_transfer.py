@@ -0,0 +1,142 @@
+import json
+import os
+import time
+
+import pytest
+
+from transfer import ChunkedDownloader, RateLimiter, TransferClient
+
+
+def make_file(server, name, size):
+    data = os.urandom(size)
+    with open(os.path.join(server.root, name), 'wb') as f:
+        f.write(data)
+    return data
+
+
+def ranges_requested(server, name):
+    return [r for path, r in server.requests if path == '/' + name]
+
+
+def test_download_in_chunks(range_server, tmp_path):
+    data = make_file(range_server, 'a.zip', 10000)
+    downloader = ChunkedDownloader(chunk_size=3000, chunks_per_file=2,
+                                   client=TransferClient(backoff_factor=0))
+    path = str(tmp_path / 'a.zip')
+    result = downloader.download(range_server.url('a.zip'), path)
+
+    assert result['bytes'] == 10000
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+    assert sorted(ranges_requested(range_server, 'a.zip')) == [
+        'bytes=0-0', 'bytes=0-2999', 'bytes=3000-5999', 'bytes=6000-8999', 'bytes=9000-9999']
+
+
+def test_retry_on_server_errors(range_server, tmp_path):
+    data = make_file(range_server, 'a.zip', 5000)
+    range_server.behaviour['/a.zip'] = {'fail': 2}
+    client = TransferClient(retries=3, backoff_factor=0)
+    path = str(tmp_path / 'a.zip')
+    ChunkedDownloader(chunk_size=2000, chunks_per_file=1, client=client).download(
+        range_server.url('a.zip'), path)
+
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    metrics = client.metrics()['127.0.0.1:{}'.format(range_server.server_address[1])]
+    assert metrics['retries'] == 2
+    assert metrics['errors'] == 0
+    assert metrics['bytes'] == 5000
+
+
+def test_retries_exhausted(range_server, tmp_path):
+    make_file(range_server, 'a.zip', 5000)
+    range_server.behaviour['/a.zip'] = {'fail': 10}
+    client = TransferClient(retries=2, backoff_factor=0)
+    with pytest.raises(Exception):
+        ChunkedDownloader(client=client).download(range_server.url('a.zip'),
+                                                  str(tmp_path / 'a.zip'))
+    metrics = client.metrics()['127.0.0.1:{}'.format(range_server.server_address[1])]
+    assert metrics['errors'] == 1
+    assert metrics['retries'] == 2
+
+
+def test_resume_interrupted_download(range_server, tmp_path):
+    data = make_file(range_server, 'a.zip', 10000)
+    range_server.behaviour['/a.zip'] = {'fail_start': 6000}
+    downloader = ChunkedDownloader(chunk_size=2000, chunks_per_file=1,
+                                   client=TransferClient(retries=0, backoff_factor=0))
+    path = str(tmp_path / 'a.zip')
+    with pytest.raises(Exception):
+        downloader.download(range_server.url('a.zip'), path)
+
+    with open(path + '.part.json') as f:
+        state = json.load(f)
+    assert state['size'] == 10000 and state['chunk_size'] == 2000
+    # the chunks queued after the failed one still complete
+    assert state['done'] == [0, 1, 2, 4]
+    assert not os.path.exists(path)
+
+    range_server.behaviour['/a.zip'] = {}
+    del range_server.requests[:]
+    result = downloader.download(range_server.url('a.zip'), path)
+
+    # only the chunks missing from the sidecar are fetched again
+    assert sorted(ranges_requested(range_server, 'a.zip')) == [
+        'bytes=0-0', 'bytes=6000-7999']
+    assert result['bytes'] == 2000
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_resume_ignores_other_layout(range_server, tmp_path):
+    data = make_file(range_server, 'a.zip', 6000)
+    path = str(tmp_path / 'a.zip')
+    with open(path + '.part', 'wb') as f:
+        f.write(b'\0' * 6000)
+    with open(path + '.part.json', 'w') as f:
+        json.dump({'url': range_server.url('a.zip'), 'size': 6000, 'chunk_size': 1000,
+                   'done': [0, 1, 2]}, f)
+
+    result = ChunkedDownloader(chunk_size=3000, client=TransferClient()).download(
+        range_server.url('a.zip'), path)
+
+    assert result['bytes'] == 6000
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_skip_complete_file(range_server, tmp_path):
+    data = make_file(range_server, 'a.zip', 3000)
+    path = str(tmp_path / 'a.zip')
+    with open(path, 'wb') as f:
+        f.write(data)
+    result = ChunkedDownloader(client=TransferClient()).download(range_server.url('a.zip'), path)
+    assert result['bytes'] == 0
+    assert ranges_requested(range_server, 'a.zip') == ['bytes=0-0']
+
+
+def test_rate_limited_download(range_server, tmp_path):
+    data = make_file(range_server, 'a.zip', 40000)
+    downloader = ChunkedDownloader(chunk_size=10000, chunks_per_file=4, block_size=1000,
+                                   max_bytes_per_sec=20000, client=TransferClient())
+    path = str(tmp_path / 'a.zip')
+    t0 = time.monotonic()
+    downloader.download(range_server.url('a.zip'), path)
+
+    # a full bucket (one second of transfer), then 20000 more bytes at 20000 bytes/s
+    assert time.monotonic() - t0 >= 0.9
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_rate_limiter_allows_large_requests():
+    limiter = RateLimiter(1000)
+    t0 = time.monotonic()
+    # more than the bucket holds goes through at once, and is paid back after
+    limiter.consume(1500)
+    assert time.monotonic() - t0 < 0.1
+    limiter.consume(500)
+    assert time.monotonic() - t0 >= 0.9
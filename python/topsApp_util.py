@@ -11,6 +11,7 @@ import boto3                      # For talking to s3 bucket
 import os
 import json
 from math import floor, ceil
+from functools import lru_cache
 import json
 import re
 import osaka
@@ -26,6 +27,20 @@ from iscesys.Component.ProductManager import ProductManager as PM
 import rasterio as rio
 from rasterio.plot import show, plotting_extent
 from rasterio.merge import merge
+from transfer import ChunkedDownloader, HedgedDownloader, get_client
+from node_cache import NodeCache
+from orbit_catalog import OrbitCatalog
+from safe_zip import extract_safe
+from burst_subset import subset_safe
+from granule_index import (GRANULE_INDEX, GranuleIndex, index_granules, index_local_granule,
+                           parse_granule_name, plan_granules)
+from command_runner import run_command
+from product_staging import stage_files, hash_file
+from cog_convert import convert_product_layers
+from footprint import get_product_footprint
+from browse import browse_files, generate_browse_images
+from isce_xml import read_sensing_times
+from run_cache import RUN_CACHE, RunCache, get_run_config, get_run_key, get_software_versions
 
 try: from html.parser import HTMLParser
 except: from html.parser import HTMLParser
@@ -42,12 +57,11 @@ PROCESSING_START=datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 PGE_BASE=os.getcwd()
 ISCE_HOME="/opt/isce2/isce"
 
-SLC_RE = re.compile(r'(?P<mission>S1\w)_IW_SLC__.*?' +
-                    r'_(?P<start_year>\d{4})(?P<start_month>\d{2})(?P<start_day>\d{2})' +
-                    r'T(?P<start_hour>\d{2})(?P<start_min>\d{2})(?P<start_sec>\d{2})' +
-                    r'_(?P<end_year>\d{4})(?P<end_month>\d{2})(?P<end_day>\d{2})' +
-                    r'T(?P<end_hour>\d{2})(?P<end_min>\d{2})(?P<end_sec>\d{2})_.*$')
+SLC_URL = "https://datapool.asf.alaska.edu/SLC/SA/{}.zip"
 
+# node-local SLC cache shared by all jobs on a worker (disabled when unset)
+SLC_CACHE_DIR = os.environ.get("SLC_CACHE_DIR")
+SLC_CACHE_MAX_BYTES = int(os.environ.get("SLC_CACHE_MAX_GB", 200)) * 1024**3
 
 QC_SERVER = 'https://qc.sentinel1.eo.esa.int/'
 DATA_SERVER = 'http://aux.sentinel1.eo.esa.int/'
@@ -55,6 +69,10 @@ DATA_SERVER = 'http://aux.sentinel1.eo.esa.int/'
 ORBITMAP = [('precise','aux_poeorb', 100),
             ('restituted','aux_resorb', 100)]
 
+# persistent orbit catalog, filled incrementally from the QC server listings
+ORBIT_CATALOG = os.environ.get("ORBIT_CATALOG", os.path.join(os.path.expanduser("~"), ".cache",
+                                                            "sds-ondemand", "orbit_catalog.sqlite"))
+
 OPER_RE = re.compile(r'S1\w_OPER_AUX_(?P<type>\w+)_OPOD_(?P<yr>\d{4})(?P<mo>\d{2})(?P<dy>\d{2})')
 sensor_name = "SENTINEL1"
 swaths = [3]
@@ -69,6 +87,42 @@ s3 = boto3.resource("s3")
 data_backup_bucket = s3.Bucket("asf-jupyter-data")
 data_backup_dir = "TOPS"
 
+# throughput below which an SLC download is hedged against the backup bucket
+HEDGE_MIN_BYTES_PER_SEC = 5 * 1024**2
+
+# AUX_CAL files used for the antenna pattern correction of IPF 002.36 products,
+# as (validity start, name) per mission; missions without an entry use S1A's
+AUX_CAL_URL = QC_SERVER + "product/{}/AUX_CAL/{}/{}.SAFE.TGZ"
+AUX_CAL_FILES = {
+    'S1A': [('20140908T000000', 'S1A_AUX_CAL_V20140908T000000_G20190626T100201')],
+}
+AUX_CACHE_DIR = os.environ.get("AUX_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache",
+                                                            "sds-ondemand", "aux"))
+AUX_CACHE_MAX_BYTES = 5 * 1024**3
+
+# topsApp.py processing steps in order, as listed by topsApp.py --help --steps of
+# ISCE 2.5; get_topsApp_steps() asks the installed topsApp.py ('ion' is missing before 2.5)
+TOPSAPP_STEPS = ['startup', 'preprocess', 'computeBaselines', 'verifyDEM', 'topo',
+                 'subsetoverlaps', 'coarseoffsets', 'coarseresamp', 'overlapifg', 'prepesd',
+                 'esd', 'rangecoreg', 'fineoffsets', 'fineresamp', 'ion', 'burstifg',
+                 'mergebursts', 'filter', 'unwrap', 'unwrap2stage', 'geocode',
+                 'denseoffsets', 'filteroffsets', 'geocodeoffsets']
+
+# topsApp state attributes holding one entry per swath (index swath - 1)
+TOPSAPP_SWATH_STATE = ['commonBurstStartReferenceIndex', 'commonBurstStartSecondaryIndex',
+                       'numberOfCommonBursts']
+# topsApp state [S, N, W, E] boxes computed over the swaths of a run (topo's
+# estimatedBbox is what geocode uses when no geocode bounding box is set)
+TOPSAPP_BBOX_STATE = ['estimatedBbox']
+
+# node-local store of 1x1 degree DEM tiles (dem.py stitch is used when unset)
+DEM_CACHE_DIR = os.environ.get("DEM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache",
+                                                            "sds-ondemand", "dem"))
+DEM_CACHE_MAX_BYTES = int(os.environ.get("DEM_CACHE_MAX_GB", 50)) * 1024**3
+
+# version of the products written by create_product, part of the run cache key
+PRODUCT_VERSION = "v1.0"
+
 # Utility to plot a 2D array
 def plotdata(GDALfilename, band=1,
              title=None,colormap='gray',
@@ -444,67 +498,156 @@ class MyHTMLParser(HTMLParser):
                 # decrement page back and page forward list items
                 self.pages -= 2
 
-def session_get(session, url):
-    return session.get(url, verify=False)
+def session_get(session, url, verify=True):
+    # session is usually the shared transfer client (pooled, with retries);
+    # TLS certificates are checked unless the caller opts out with verify=False
+    return session.get(url, verify=verify)
 
-def get_download_orbit_dict(download_orbit_dict, slc_date, mission_type):
-    
-
-    logger.info("slc_date : {}".format(slc_date))
-    url = "https://qc.sentinel1.eo.esa.int/aux_poeorb/?validity_start={}&sentinel1__mission={}".format(slc_date, mission_type)
-    session = requests.Session()
-    r = session_get(session, url)
+def list_qc_orbits(orbit_type, slc_date, mission_type):
+    '''
+        Scrape the QC server listing of the orbit_type ("aux_poeorb") orbits
+        whose validity starts on slc_date, as (name, url) pairs.
+    '''
+    logger.info("list_qc_orbits : {} {} {}".format(orbit_type, slc_date, mission_type))
+    url = "{}{}/?validity_start={}&sentinel1__mission={}".format(QC_SERVER, orbit_type, slc_date, mission_type)
+    r = session_get(get_client(), url)
     r.raise_for_status()
     parser = MyHTMLParser()
     parser.feed(r.text)
 
+    orbits = []
     for res in parser.fileList:
-        #id = "%s-%s" % (os.path.splitext(res)[0], dataset_version)
         match = OPER_RE.search(res)
         if not match:
             raise RuntimeError("Failed to parse orbit: {}".format(res))
-        download_orbit_dict[res] = os.path.join(DATA_SERVER, "/".join(match.groups()), "{}.EOF".format(res))
-        #yield id, results[id]
-        
-    #logger.info(results)
+        orbits.append((res, os.path.join(DATA_SERVER, "/".join(match.groups()), "{}.EOF".format(res))))
+    return orbits
+
+def update_orbit_catalog(catalog, slc_date, mission_type, orbit_type='aux_poeorb'):
+    '''Harvest the listing page of slc_date into the catalog unless already done.'''
+    if catalog.is_scanned(mission_type, orbit_type, slc_date):
+        return 0
+    count = catalog.add(list_qc_orbits(orbit_type, slc_date, mission_type))
+    catalog.mark_scanned(mission_type, orbit_type, slc_date)
+    logger.info("update_orbit_catalog : added {} orbits for {}".format(count, slc_date))
+    return count
+
+def get_download_orbit_dict(download_orbit_dict, slc_date, mission_type,
+                            start_time=None, end_time=None, catalog=None):
+    '''
+        Add to download_orbit_dict the precise orbits covering [start_time,
+        end_time], by default the whole day after slc_date. Orbits are looked
+        up in the local catalog, which is only filled from the QC server for
+        days it has not harvested yet.
+    '''
+    from datetime import timedelta
+
+    logger.info("slc_date : {}".format(slc_date))
+    if catalog is None:
+        catalog = OrbitCatalog(ORBIT_CATALOG)
+    if start_time is None:
+        start_time = datetime.strptime(slc_date, '%Y-%m-%d') + timedelta(days=1)
+        end_time = start_time + timedelta(days=1) - timedelta(seconds=1)
+
+    update_orbit_catalog(catalog, slc_date, mission_type)
+    for name, url, _, _ in catalog.lookup(mission_type, 'aux_poeorb', start_time, end_time):
+        download_orbit_dict[name] = url
     
     return download_orbit_dict
 
-def get_orbit_files(localize_slcs):
-    from datetime import datetime, timedelta
+def get_acquisitions(localize_slcs):
+    '''
+        Group SLC IDs into acquisitions: {(mission, date): [slc, ...]}, so
+        that consecutive frames of one pass share a single orbit.
+    '''
+    acquisitions = {}
+    for slc in localize_slcs:
+        _, mission, start_time, _ = parse_granule_name(slc)
+        acquisitions.setdefault((mission, start_time.strftime('%Y-%m-%d')), []).append(slc)
+    return acquisitions
+
+def select_orbit(mission, start_time, end_time, catalog=None, margin=60):
+    '''
+        Pick the one orbit file whose validity covers [start_time, end_time]
+        padded by margin seconds, trying the ORBITMAP types by priority
+        (precise first, then restituted). Returns (name, url).
+    '''
+    from datetime import timedelta
+
+    if catalog is None:
+        catalog = OrbitCatalog(ORBIT_CATALOG)
+    start_time = start_time - timedelta(seconds=margin)
+    end_time = end_time + timedelta(seconds=margin)
+
+    # sorted() is stable, so ORBITMAP order breaks ties in priority
+    for orbit_label, orbit_type, priority in sorted(ORBITMAP, key=lambda o: o[2], reverse=True):
+        orbits = catalog.lookup(mission, orbit_type, start_time, end_time)
+        # orbits covering an acquisition start on the day before or the same day
+        for day_dt in (start_time - timedelta(days=1), start_time):
+            if orbits:
+                break
+            if update_orbit_catalog(catalog, day_dt.strftime('%Y-%m-%d'), mission, orbit_type):
+                orbits = catalog.lookup(mission, orbit_type, start_time, end_time)
+        if orbits:
+            name, url, validity_start, validity_stop = orbits[0]
+            logger.info("select_orbit : {} orbit {} ({} - {})".format(
+                orbit_label, name, validity_start, validity_stop))
+            return name, url
+    raise RuntimeError("No orbit found for {} covering {} - {}".format(mission, start_time, end_time))
+
+def get_orbit_fetch_plan(localize_slcs, catalog=None):
+    '''
+        Deduplicated {orbit name: url} plan with the single covering orbit of
+        every acquisition in localize_slcs.
+    '''
+    if catalog is None:
+        catalog = OrbitCatalog(ORBIT_CATALOG)
+
+    fetch_plan = {}
+    for (mission, day), slcs in get_acquisitions(localize_slcs).items():
+        start_time, end_time = get_start_end_times(slcs)
+        logger.info("get_orbit_fetch_plan : {} {} {} - {}".format(mission, day, start_time, end_time))
+        name, url = select_orbit(mission, start_time, end_time, catalog)
+        fetch_plan[name] = url
+    return fetch_plan
+
+def fetch_orbits(fetch_plan, orbit_dir, max_workers=4):
+    '''
+        Download the orbits of fetch_plan into orbit_dir concurrently, skipping
+        files already present. Returns per-orbit bytes and seconds.
+    '''
+    if not os.path.exists(orbit_dir):
+        os.makedirs(orbit_dir)
+
+    results = []
+    jobs = []
+    for name, url in fetch_plan.items():
+        path = os.path.join(orbit_dir, os.path.basename(url))
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            results.append({'url': url, 'path': path, 'bytes': 0, 'seconds': 0.0})
+        else:
+            jobs.append((url, path))
+
+    downloader = ChunkedDownloader(max_files=max_workers, chunks_per_file=1)
+    results.extend(downloader.download_many(jobs))
+    for res in results:
+        logger.info("fetch_orbits : {} : {} bytes in {:.1f} s".format(
+            os.path.basename(res['path']), res['bytes'], res['seconds']))
+    get_client().log_metrics()
+    return results
+
+def get_orbit_files(localize_slcs, orbit_dir=None, max_workers=4):
+    '''
+        Download the orbits of all SLCs into orbit_dir (the current
+        directory by default), each orbit once.
+    '''
     import json
-    import os
-    import osaka
-    import osaka.main
-    
-    orbit_dict = {}
 
-    orbit_dates = []
-    
-    for slc in localize_slcs:
-        match = SLC_RE.search(slc)
-        if not match:
-            raise RuntimeError("Failed to recognize SLC ID %s." %slc)
-        mission = match.group('mission')
-        day_dt_str = "{}-{}-{}".format(match.group('start_year'), 
-                                       match.group('start_month'), match.group('start_day'))
-        
-        day_dt = datetime.strptime(day_dt_str, '%Y-%m-%d') - timedelta(days=1)
-        
-        day_dt_str = day_dt.strftime('%Y-%m-%d')
-        
-        logger.info("day_dt_str : {}".format(day_dt_str))
-        if day_dt_str not in orbit_dates:
-            orbit_dates.append(day_dt_str)
-            orbit_dict = get_download_orbit_dict(orbit_dict, day_dt_str, mission)
-            directory = orbit_dir
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            #directory = os.path.join(wd, "orbits")
-            for k, v in orbit_dict.items():
-                osaka.main.get(v, directory)
-         
+    if orbit_dir is None:
+        orbit_dir = os.getcwd()
+    orbit_dict = get_orbit_fetch_plan(localize_slcs)
     logger.info("orbit_dict : %s " %json.dumps(orbit_dict, indent=4))
+    return fetch_orbits(orbit_dict, orbit_dir, max_workers)
 
 def get_area(coords):
     '''get area of enclosed coordinates- determines clockwise or counterclockwise order'''
@@ -519,72 +662,659 @@ def get_area(coords):
     #area = abs(area) / 2.0
     return old_div(area, 2)
 
-def download_slc(slc_id, path):
-    url = "https://datapool.asf.alaska.edu/SLC/SA/{}.zip".format(slc_id)
+def download_slc(slc_id, path, downloader=None):
+    url = SLC_URL.format(slc_id)
     logger.info("Downloading {} : {}".format(slc_id, url))
     
     if not os.path.exists(path):
         os.makedirs(path)
-    osaka.main.get(url, path)
+    if downloader is None:
+        downloader = ChunkedDownloader()
+    return downloader.download(url, os.path.join(path, "{}.zip".format(slc_id)))
 
 def run_cmd_output(cmd):
-    from subprocess import check_output, CalledProcessError
+    from subprocess import CalledProcessError
     cmd_line = " ".join(cmd)
-    logger.info("Calling: {}".format(cmd_line))
-    output = check_output(cmd_line, shell=True)
-    return output
+    result = run_command(cmd_line, shell=True, capture=True, tail_lines=20)
+    if not result.ok:
+        raise CalledProcessError(result.exit_code, cmd_line, output=result.output)
+    return result.output
 
-def run_cmd(cmd):
-    import subprocess
-    from subprocess import check_call, CalledProcessError
-    import sys
-    cmd_line = " ".join(cmd)
-    logger.info("Calling : {}".format(cmd_line))
-    p = subprocess.Popen(cmd_line, shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-    while True: 
-        line = p.stdout.readline()
-        if not line:
+def run_cmd(cmd, log_file=None, cwd=None, tail_lines=20, env=None, cpus=None):
+    '''
+        Run cmd through the shell and return its CommandResult. The whole
+        output is written to log_file, by default appended to <program>.log in
+        cwd (e.g. dem.log for dem.py). Without an explicit log_file, and always
+        on failure, its last tail_lines lines are also logged.
+    '''
+    append = log_file is None
+    if log_file is None:
+        program = os.path.splitext(os.path.basename(cmd[0]))[0]
+        log_file = os.path.join(cwd or ".", "{}.log".format(program))
+    result = run_command(" ".join(cmd), log_file=log_file, cwd=cwd, env=env, shell=True,
+                         tail_lines=tail_lines, append=append, cpus=cpus)
+    if append or not result.ok:
+        logger.info("run_cmd : full output in {}".format(log_file))
+        for line in result.tail:
+            logger.info(line)
+    return result
+
+@lru_cache(maxsize=None)
+def get_topsApp_steps(isce_home=ISCE_HOME):
+    '''
+        Processing steps of the installed topsApp.py, in order, parsed from
+        topsApp.py --help --steps. Falls back to TOPSAPP_STEPS without the
+        steps of newer ISCE versions ('ion') when they cannot be listed.
+    '''
+    try:
+        result = run_command(["{}/applications/topsApp.py".format(isce_home), "--help",
+                              "--steps"], capture=True)
+        text = result.output.decode('utf-8', 'replace')
+    except OSError:
+        text = ''
+    marker = text.find("following list")
+    steps = re.findall(r"'(\w+)'", text[marker:]) if marker >= 0 else []
+    if not steps:
+        logger.info("get_topsApp_steps : could not list the steps of topsApp.py, "
+                    "assuming ISCE < 2.5")
+        return tuple(step for step in TOPSAPP_STEPS if step != 'ion')
+    return tuple(steps)
+
+def run_topsApp_steps(work_dir=".", start="startup", end="geocode", steps=None,
+                      xml_file="topsApp.xml", manifest_file="topsApp_steps.json", env=None,
+                      cpus=None):
+    '''
+        Run topsApp.py in work_dir one step at a time (--dostep), from start to
+        end, recording each completed step in a JSON manifest with its wall
+        time, peak RSS, CPU times, I/O bytes, log file and the top-level
+        outputs it created or changed, with its own PICKLE/<step> checkpoint.
+        A rerun skips the steps the manifest lists as done, as long as the
+        checkpoint of the last one is still there, so a killed job restarts
+        from the last good step. steps defaults to those of the installed
+        topsApp.py, see get_topsApp_steps.
+    '''
+    if steps is None:
+        steps = get_topsApp_steps(ISCE_HOME)
+    steps = list(steps)
+    steps = steps[steps.index(start):steps.index(end) + 1]
+    manifest_path = os.path.join(work_dir, manifest_file)
+    manifest = {'steps': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    def snapshot():
+        # each step adds its checkpoint to PICKLE: look at the files, not the dir
+        names = [name for name in os.listdir(work_dir) if name != "PICKLE"]
+        if os.path.isdir(os.path.join(work_dir, "PICKLE")):
+            names += ["PICKLE/{}".format(name)
+                      for name in os.listdir(os.path.join(work_dir, "PICKLE"))]
+        return {name: os.stat(os.path.join(work_dir, name)).st_mtime for name in names}
+
+    # resume after the last recorded step whose checkpoint still exists
+    first = 0
+    for i, step in enumerate(steps):
+        if manifest['steps'].get(step, {}).get('status') != 'done':
             break
-        logger.info(line.strip())
-        sys.stdout.flush()
-        
-def download_dem(min_lat, max_lat, min_lon, max_lon):
+        if not os.path.exists(os.path.join(work_dir, "PICKLE", step)):
+            break
+        first = i + 1
+    if first:
+        logger.info("run_topsApp_steps : resuming after {}".format(steps[first - 1]))
+
+    for step in steps[first:]:
+        before = snapshot()
+        cmd = ["{}/applications/topsApp.py".format(ISCE_HOME), xml_file,
+               "--dostep={}".format(step)]
+        result = run_cmd(cmd, log_file=os.path.join(work_dir, "topsApp_{}.log".format(step)),
+                         cwd=work_dir, env=env, cpus=cpus)
+        after = snapshot()
+        record = dict(result.as_dict(), status='done' if result.ok else 'failed',
+                      finished=datetime.utcnow().isoformat(),
+                      outputs=sorted(name for name, mtime in after.items()
+                                     if before.get(name) != mtime and name != manifest_file
+                                     and name != os.path.basename(result.log_file)))
+        manifest['steps'][step] = record
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        logger.info("run_topsApp_steps : {} {} in {:.1f} s, peak RSS {:.0f} MB".format(
+            step, record['status'], record['wall_time'], record['maxrss_kb'] / 1024))
+        if not result.ok:
+            raise RuntimeError("topsApp.py step {} failed with exit code {}, see {}".format(
+                step, result.exit_code, result.log_file))
+    return manifest
+
+def link_swath_outputs(work_dir, swath_dir, swath):
+    '''
+        Symlink the IW<swath> products of a per-swath run (reference/IW1,
+        fine_interferogram/IW1.xml, ...) into the matching directories of
+        work_dir. Existing entries that are not symlinks are left alone.
+    '''
+    prefix = 'IW{}'.format(swath)
+    for entry in os.listdir(swath_dir):
+        src_dir = os.path.join(swath_dir, entry)
+        if entry == 'PICKLE' or os.path.islink(src_dir) or not os.path.isdir(src_dir):
+            continue
+        for name in os.listdir(src_dir):
+            if name != prefix and not name.startswith(prefix + '.'):
+                continue
+            dest = os.path.join(work_dir, entry, name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.islink(dest):
+                os.remove(dest)
+            elif os.path.exists(dest):
+                logger.info("link_swath_outputs : keeping existing {}".format(dest))
+                continue
+            os.symlink(os.path.abspath(os.path.join(src_dir, name)), dest)
+
+def merge_swath_state(work_dir, swath_dirs, step="burstifg", names=TOPSAPP_SWATH_STATE,
+                      bbox_names=TOPSAPP_BBOX_STATE):
+    '''
+        Write work_dir/PICKLE/<step> from the topsApp states that per-swath
+        runs saved after step. The per-swath attributes listed in names (common
+        burst limits) are indexed by swath - 1, so each swath's entry is taken
+        from its own run; the boxes listed in bbox_names become the union of
+        those of all runs; everything else comes from the first run. Raises
+        RuntimeError if a run's state lacks one of them.
+    '''
+    import pickle
+
+    states = {}
+    for swath, swath_dir in swath_dirs.items():
+        with open(os.path.join(swath_dir, "PICKLE", step), 'rb') as f:
+            states[swath] = pickle.load(f)
+    swaths = sorted(states)
+    merged = states[swaths[0]]
+    for name in names:
+        for swath in swaths:
+            value = getattr(states[swath], name, None)
+            if not isinstance(value, list) or len(value) < swath:
+                raise RuntimeError("merge_swath_state : {} state of IW{} has no per-swath {}".format(
+                    step, swath, name))
+        value = list(getattr(merged, name))
+        for swath in swaths[1:]:
+            value[swath - 1] = getattr(states[swath], name)[swath - 1]
+        setattr(merged, name, value)
+    for name in bbox_names:
+        boxes = []
+        for swath in swaths:
+            box = getattr(states[swath], name, None)
+            if box is None or len(box) != 4:
+                raise RuntimeError("merge_swath_state : {} state of IW{} has no {}".format(
+                    step, swath, name))
+            boxes.append(box)
+        setattr(merged, name, [min(box[0] for box in boxes), max(box[1] for box in boxes),
+                               min(box[2] for box in boxes), max(box[3] for box in boxes)])
+    os.makedirs(os.path.join(work_dir, "PICKLE"), exist_ok=True)
+    with open(os.path.join(work_dir, "PICKLE", step), 'wb') as f:
+        pickle.dump(merged, f)
+
+def run_topsApp_swaths(work_dir, tops_properties, input_dict, end="geocode", cpus=None):
+    '''
+        Run topsApp with each IW swath of tops_properties["swaths"] in its own
+        process, then merge them. work_dir must hold reference.xml,
+        secondary.xml and the DEM, as for run_topsApp_steps.
+
+        Each swath runs startup to burstifg in a sibling <work_dir>_IW<n>
+        directory, configured by create_topsApp_xml with the same properties
+        but a single swath, and pinned to an equal share of cpus (all CPUs
+        available to this process by default). Their products are then linked
+        into work_dir, their states merged, and mergebursts to end run there
+        on all swaths. Returns the manifest of the work_dir run.
+
+        Limitation: each swath estimates its ESD azimuth and range
+        misregistration from its own burst overlaps, where a single topsApp
+        run estimates them jointly over all swaths, so the merged
+        interferogram can show phase steps between subswaths. This mode is
+        therefore off by default (parallel_swaths in the notebook PGE) and
+        meant for jobs where wall time matters more than those steps.
+    '''
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    work_dir = os.path.abspath(work_dir)
+    swaths = tops_properties["swaths"]
+    if isinstance(swaths, str):
+        swaths = json.loads(swaths)
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0))
+    share = max(1, len(cpus) // len(swaths))
+    create_topsApp_xml(tops_properties, input_dict, os.path.join(work_dir, "topsApp.xml"))
+
+    swath_dirs = {}
+    swath_cpus = {}
+    for i, swath in enumerate(swaths):
+        swath_dir = "{}_IW{}".format(work_dir, swath)
+        os.makedirs(swath_dir, exist_ok=True)
+        for xml_file in ("reference.xml", "secondary.xml"):
+            shutil.copy(os.path.join(work_dir, xml_file), swath_dir)
+        dem_name = os.path.basename(input_dict["wgs84_file"])
+        link_shared_inputs(swath_dir, work_dir, dem_name, os.path.join(work_dir, "AuxDir"))
+        create_topsApp_xml(dict(tops_properties, swaths=[swath]), input_dict,
+                           os.path.join(swath_dir, "topsApp.xml"))
+        swath_dirs[swath] = swath_dir
+        swath_cpus[swath] = cpus[i * share:(i + 1) * share] or cpus
+
+    def run_swath(swath):
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(swath_cpus[swath])))
+        return run_topsApp_steps(swath_dirs[swath], "startup", "burstifg", env=env,
+                                 cpus=swath_cpus[swath])
+
+    with ThreadPoolExecutor(max_workers=len(swaths)) as pool:
+        list(pool.map(run_swath, swaths))
+
+    for swath, swath_dir in swath_dirs.items():
+        link_swath_outputs(work_dir, swath_dir, swath)
+    merge_swath_state(work_dir, swath_dirs)
+    return run_topsApp_steps(work_dir, "mergebursts", end, cpus=cpus)
+
+def get_dem_name(min_lat, max_lat, min_lon, max_lon):
+    '''Name dem.py -c gives the ellipsoid-corrected DEM of an integer bbox.'''
+    def lat_name(lat):
+        return "{}{:02d}".format('S' if lat < 0 else 'N', abs(lat))
+    def lon_name(lon):
+        return "{}{:03d}".format('W' if lon < 0 else 'E', abs(lon))
+    return "demLat_{}_{}_Lon_{}_{}.dem.wgs84".format(lat_name(min_lat), lat_name(max_lat),
+                                                     lon_name(min_lon), lon_name(max_lon))
+
+def get_dem_tiles(min_lat, max_lat, min_lon, max_lon):
+    '''South-west corners (lat, lon) of the 1x1 degree tiles covering a bbox.'''
     from math import floor, ceil
-    min_lat_lo = floor(min_lat)
-    max_lat_hi = ceil(max_lat)
-    min_lon_lo = floor(min_lon)
-    max_lon_hi = ceil(max_lon)
+    lat_lo, lon_lo = floor(min_lat), floor(min_lon)
+    lat_hi, lon_hi = max(ceil(max_lat), lat_lo + 1), max(ceil(max_lon), lon_lo + 1)
+    return [(lat, lon) for lat in range(lat_lo, lat_hi) for lon in range(lon_lo, lon_hi)]
+
+def stitch_dem(min_lat, max_lat, min_lon, max_lon, out_dir="."):
+    '''Run dem.py to stitch the 1 arcsec, ellipsoid-corrected DEM of a bbox into out_dir.'''
     ISCE_HOME="/opt/isce2/isce"
-    
     dem_cmd = [
         "{}/applications/dem.py".format(ISCE_HOME), "-a",
-        "stitch", "-b", "{} {} {} {}".format(min_lat_lo, max_lat_hi, min_lon_lo, max_lon_hi),
+        "stitch", "-b", "{} {} {} {}".format(min_lat, max_lat, min_lon, max_lon),
         "-r", "-s", "1", "-f", "-c", "|", "tee", "dem.txt"
         #"-n", dem_user, "-w", dem_pass,"-u", dem_url
     ]
-    run_cmd(dem_cmd)
-        
-def download_slcs(localize_slcs, path):
-    for slc in localize_slcs:
-        download_slc(slc, path) 
+    run_cmd(dem_cmd, cwd=out_dir)
+    return os.path.join(out_dir, get_dem_name(min_lat, max_lat, min_lon, max_lon))
+
+def get_dem_tile(cache, lat, lon, tiles_dir):
+    '''
+        Link the cached ellipsoid DEM of the tile at (lat, lon) into tiles_dir,
+        stitching it on a miss, and return the path of the linked DEM.
+    '''
+    import shutil
+
+    name = get_dem_name(lat, lat + 1, lon, lon + 1)
+
+    def fill(tmp_path):
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        dem_file = stitch_dem(lat, lat + 1, lon, lon + 1, tmp_path)
+        if not os.path.exists(dem_file):
+            raise RuntimeError("dem.py did not produce {}".format(dem_file))
+        # keep only the corrected DEM and its headers
+        for fname in os.listdir(tmp_path):
+            if not fname.startswith(name):
+                os.remove(os.path.join(tmp_path, fname))
+
+    key = name.split('.')[0]
+    cache.fetch(key, fill, os.path.join(tiles_dir, key))
+    return os.path.join(tiles_dir, key, name)
+
+def download_dem(min_lat, max_lat, min_lon, max_lon, cache_dir=DEM_CACHE_DIR,
+                 cache_max_bytes=DEM_CACHE_MAX_BYTES, max_workers=4, out_dir="."):
+    '''
+        Stage in out_dir the 1 arcsec, ellipsoid-corrected DEM of
+        the bbox rounded out to whole degrees, named as dem.py names it, and
+        write its name to dem.txt. Returns the DEM file name.
+
+        With a cache_dir, 1x1 degree tiles are kept in a node-local NodeCache:
+        only missing tiles are stitched, and the cached ones are mosaicked with
+        a VRT and written out with an ISCE header.
+    '''
+    import shutil
+    from math import floor, ceil
+    from concurrent.futures import ThreadPoolExecutor
+    import isceobj
+
+    min_lat_lo = floor(min_lat)
+    max_lat_hi = ceil(max_lat)
+    min_lon_lo = floor(min_lon)
+    max_lon_hi = ceil(max_lon)
+    if cache_dir is None:
+        return os.path.basename(stitch_dem(min_lat_lo, max_lat_hi, min_lon_lo, max_lon_hi,
+                                           out_dir))
+
+    cache = NodeCache(cache_dir, cache_max_bytes)
+    tiles = get_dem_tiles(min_lat, max_lat, min_lon, max_lon)
+    tiles_dir = os.path.join(out_dir, "dem_tiles")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        tile_files = list(pool.map(lambda tile: get_dem_tile(cache, *tile, tiles_dir), tiles))
+
+    dem_name = get_dem_name(min_lat_lo, max_lat_hi, min_lon_lo, max_lon_hi)
+    dem_file = os.path.join(out_dir, dem_name)
+    mosaic = gdal.BuildVRT("{}.tiles.vrt".format(dem_file), tile_files)
+    mosaic = None
+    ds = gdal.Translate(dem_file, "{}.tiles.vrt".format(dem_file), format="ENVI")
+    width, length = ds.RasterXSize, ds.RasterYSize
+    lon0, dlon, _, lat0, _, dlat = ds.GetGeoTransform()
+    ds = None
+    os.remove("{}.tiles.vrt".format(dem_file))
+
+    # ISCE coordinates refer to pixel centres, GDAL geotransforms to corners
+    img = isceobj.createDemImage()
+    img.load(tile_files[0] + '.xml')
+    img.setFilename(dem_file)
+    img.setWidth(width)
+    img.setLength(length)
+    img.setFirstLongitude(lon0 + dlon / 2)
+    img.setDeltaLongitude(dlon)
+    img.setFirstLatitude(lat0 + dlat / 2)
+    img.setDeltaLatitude(dlat)
+    img.setAccessMode('read')
+    img.renderHdr()
+    shutil.rmtree(tiles_dir)
+
+    with open(os.path.join(out_dir, "dem.txt"), "w") as fw:
+        fw.write("Stitched DEM from {} cached tiles : {}\n".format(len(tiles), dem_name))
+    logger.info("download_dem : {} from {} tiles".format(dem_file, len(tiles)))
+    return dem_name
+
+def get_slc_cache_key(slc_id):
+    '''Cache key of an SLC zip: the granule ID as recognized by parse_granule_name.'''
+    return "{}.zip".format(parse_granule_name(slc_id)[0])
+
+def resolve_aux_cal(mission, sensing_time):
+    '''
+        (name, url) of the AUX_CAL file valid for mission at sensing_time: the
+        latest one whose validity starts before it (or the earliest one).
+    '''
+    entries = AUX_CAL_FILES.get(mission)
+    if not entries:
+        logger.info("resolve_aux_cal : no AUX_CAL listed for {}, using S1A".format(mission))
+        mission, entries = 'S1A', AUX_CAL_FILES['S1A']
+    entries = sorted(entries)
+    validity, name = entries[0]
+    for entry_validity, entry_name in entries:
+        if datetime.strptime(entry_validity, '%Y%m%dT%H%M%S') <= sensing_time:
+            validity, name = entry_validity, entry_name
+    return name, AUX_CAL_URL.format(mission, validity, name)
+
+def get_aux_cal(localize_slcs, aux_dir='AuxDir', cache_dir=AUX_CACHE_DIR,
+                cache_max_bytes=AUX_CACHE_MAX_BYTES):
+    '''
+        Make the AUX_CAL files needed by localize_slcs available in aux_dir.
+        Each file is downloaded and unpacked once per node into the aux cache
+        and linked into aux_dir, replacing the per-job wget and tar.
+    '''
+    import shutil
+    import tarfile
+
+    cache = NodeCache(cache_dir, cache_max_bytes)
+    os.makedirs(aux_dir, exist_ok=True)
+
+    aux_files = {}
+    for (mission, day), slcs in get_acquisitions(localize_slcs).items():
+        start_time, _ = get_start_end_times(slcs)
+        name, url = resolve_aux_cal(mission, start_time)
+        aux_files[name] = url
+
+    linked = []
+    for name, url in aux_files.items():
+        key = "{}.SAFE".format(name)
+
+        def fill(tmp_path):
+            tgz_file = tmp_path + '.TGZ'
+            unpack_dir = tmp_path + '.unpack'
+            ChunkedDownloader(chunks_per_file=1).download(url, tgz_file)
+            if os.path.exists(unpack_dir):
+                shutil.rmtree(unpack_dir)
+            with tarfile.open(tgz_file, 'r:gz') as tf:
+                if hasattr(tarfile, 'data_filter'):
+                    tf.extractall(unpack_dir, filter='data')
+                else:
+                    tf.extractall(unpack_dir)
+            entries = os.listdir(unpack_dir)
+            if len(entries) == 1:
+                os.replace(os.path.join(unpack_dir, entries[0]), tmp_path)
+                os.rmdir(unpack_dir)
+            else:
+                os.replace(unpack_dir, tmp_path)
+            os.remove(tgz_file)
+
+        linked.append(os.path.join(aux_dir, key))
+        cache.fetch(key, fill, linked[-1])
+        logger.info("get_aux_cal : {}".format(linked[-1]))
+    return linked
+
+def get_slc_fetcher(path, downloader, url_template=None,
+                    cache_dir=SLC_CACHE_DIR, cache_max_bytes=SLC_CACHE_MAX_BYTES,
+                    hedge=False, hedge_min_bytes_per_sec=HEDGE_MIN_BYTES_PER_SEC):
+    '''
+        Return a function downloading one SLC ID into path, going through the
+        node-local cache when cache_dir is set. With hedge, a slow or failing
+        download is raced against the copy in data_backup_bucket.
+    '''
+    if url_template is None:
+        url_template = SLC_URL
+    if not os.path.exists(path):
+        os.makedirs(path)
+    cache = NodeCache(cache_dir, cache_max_bytes) if cache_dir is not None else None
+    hedger = None
+    if hedge:
+        hedger = HedgedDownloader(data_backup_bucket, downloader,
+                                  min_bytes_per_sec=hedge_min_bytes_per_sec)
+
+    def transfer(slc, url, dest):
+        if hedger is None:
+            return downloader.download(url, dest)
+        key = "{}/{}.zip".format(data_backup_dir, slc)
+        return hedger.download(url, key, dest)
+
+    def fetch(slc):
+        url = url_template.format(slc)
+        dest = os.path.join(path, "{}.zip".format(slc))
+        if cache is None:
+            return transfer(slc, url, dest)
+
+        res = {'url': url, 'path': dest, 'bytes': 0, 'seconds': 0.0}
+        key = get_slc_cache_key(slc)
+
+        def fill(tmp_path):
+            res.update(transfer(slc, url, tmp_path), path=dest)
+
+        cache.fetch(key, fill, dest)
+        return res
+
+    return fetch
+
+def plan_slc_downloads(localize_slcs, min_lat, max_lat, min_lon, max_lon, swaths=None,
+                       index=None, url_template=None, margin=0.05, max_workers=4):
+    '''
+        Before downloading, find which SLCs and swaths actually cover the AOI
+        from the burst geometry in the granule index (granules not indexed
+        yet are indexed from their remote annotations). Returns the plan of
+        granule_index.plan_granules, with the kept SLCs under 'slcs'.
+    '''
+    if index is None:
+        index = GranuleIndex(GRANULE_INDEX)
+    if url_template is None:
+        url_template = SLC_URL
+    index_granules(index, localize_slcs, url_template, max_workers=max_workers)
+    plan = plan_granules(index, localize_slcs, (min_lat, max_lat, min_lon, max_lon),
+                         swaths, margin)
+    plan['slcs'] = plan.pop('granules')
+
+    for slc in plan['slcs']:
+        logger.info("plan_slc_downloads : keep {} : bursts {}".format(slc, plan['bursts'][slc]))
+    for slc, reason in plan['dropped'].items():
+        logger.info("plan_slc_downloads : drop {} : {}".format(slc, reason))
+    logger.info("plan_slc_downloads : {} of {} SLCs, swaths {}".format(
+        len(plan['slcs']), len(set(localize_slcs)), plan['swaths']))
+    return plan
+
+def download_slcs(localize_slcs, path, max_files=4, chunks_per_file=4,
+                  max_bytes_per_sec=None, url_template=None,
+                  cache_dir=SLC_CACHE_DIR, cache_max_bytes=SLC_CACHE_MAX_BYTES,
+                  hedge=False):
+    '''
+        Download several SLCs at once, each split into parallel byte-range chunks.
+        Interrupted downloads are resumed from the chunks already on disk.
+
+        When cache_dir is set, SLCs go through the node-local cache and are
+        hard linked (or symlinked) into path, so granules already pulled by
+        an earlier job on this node cost no network I/O.
+
+        With hedge, a download running slower than HEDGE_MIN_BYTES_PER_SEC (or
+        failing) is raced against the copy under data_backup_dir in
+        data_backup_bucket, and the first one to finish is kept.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the same granule can be listed by several pairs
+    slcs = list(dict.fromkeys(localize_slcs))
+
+    downloader = ChunkedDownloader(max_files=max_files, chunks_per_file=chunks_per_file,
+                                   max_bytes_per_sec=max_bytes_per_sec)
+    fetch = get_slc_fetcher(path, downloader, url_template, cache_dir, cache_max_bytes, hedge)
+    with ThreadPoolExecutor(max_workers=max_files) as pool:
+        results = list(pool.map(fetch, slcs))
+
+    for res in results:
+        logger.info("download_slcs : {} : {} bytes in {:.1f} s".format(
+            res['path'], res['bytes'], res['seconds']))
+    get_client().log_metrics()
+
+    # inventory the zips once here, later lookups query the granule index
+    index = GranuleIndex(GRANULE_INDEX)
+    for res in results:
+        index_local_granule(index, res['path'])
+    return results
+
+def download_burst_subsets(localize_slcs, path, min_lat, max_lat, min_lon, max_lon,
+                           swaths=None, polarization='vv', max_files=2, url_template=None,
+                           cache_dir=SLC_CACHE_DIR, cache_max_bytes=SLC_CACHE_MAX_BYTES):
+    '''
+        Fetch from each remote SLC zip only the bursts that intersect the AOI
+        and write them as minimal SAFE directories in path. A granule whose
+        measurement TIFFs cannot be read by range (e.g. deflated in the zip)
+        is downloaded whole instead and its swaths and polarization
+        extracted. Use create_xml(..., safe_ext="SAFE") to point topsApp at
+        the SAFE directories.
+
+        Returns one result per SLC that has bursts in the AOI, with its 'slc'
+        ID; SLCs without any are left out (and logged), for the caller to
+        drop from its reference/secondary lists.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    if url_template is None:
+        url_template = SLC_URL
+    if not os.path.exists(path):
+        os.makedirs(path)
+    bbox = (min_lat, max_lat, min_lon, max_lon)
+    fetch = get_slc_fetcher(path, ChunkedDownloader(max_files=max_files), url_template,
+                            cache_dir, cache_max_bytes)
+
+    def subset(slc):
+        try:
+            return dict(subset_safe(url_template.format(slc), path, bbox, swaths, polarization),
+                        slc=slc)
+        except ValueError as e:
+            logger.warning("download_burst_subsets : {} : {}, dropping it".format(slc, e))
+            return None
+        except RuntimeError as e:
+            logger.warning("download_burst_subsets : {} : {}, downloading the full SLC".format(
+                slc, e))
+        res = fetch(slc)
+        extract_safe(res['path'], path, swaths, polarization)
+        os.remove(res['path'])
+        return {'slc': slc, 'safe': os.path.join(path, "{}.SAFE".format(slc)), 'bursts': None,
+                'bytes': res['bytes'], 'full_size': res['bytes']}
+
+    with ThreadPoolExecutor(max_workers=max_files) as pool:
+        results = [res for res in pool.map(subset, list(dict.fromkeys(localize_slcs)))
+                   if res is not None]
+    for res in results:
+        logger.info("download_burst_subsets : {} : bursts {} : {} of {} bytes".format(
+            res['safe'], res['bursts'] or 'all', res['bytes'], res['full_size']))
+    return results
+
+def download_and_extract_slcs(localize_slcs, path, max_files=4, extract_workers=2,
+                              queue_size=2, chunks_per_file=4, max_bytes_per_sec=None,
+                              url_template=None, cache_dir=SLC_CACHE_DIR,
+                              cache_max_bytes=SLC_CACHE_MAX_BYTES,
+                              swaths=None, polarization=None, hedge=False):
+    '''
+        Download SLCs and unzip them into path as a pipeline: extraction of
+        a granule starts as soon as it is downloaded, while the next ones are
+        still in flight. Finished downloads wait in a queue of queue_size
+        entries for one of the extract_workers. swaths and polarization limit
+        what is extracted, see extract_slc; hedge as in download_slcs. Each
+        zip is removed from path once extracted.
+    '''
+    import queue
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    slcs = list(dict.fromkeys(localize_slcs))
+    downloader = ChunkedDownloader(max_files=max_files, chunks_per_file=chunks_per_file,
+                                   max_bytes_per_sec=max_bytes_per_sec)
+    fetch = get_slc_fetcher(path, downloader, url_template, cache_dir, cache_max_bytes, hedge)
+
+    downloaded = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def download(slc):
+        res = fetch(slc)
+        logger.info("download_and_extract_slcs : downloaded {} : {} bytes in {:.1f} s".format(
+            res['path'], res['bytes'], res['seconds']))
+        downloaded.put(res)
+        return res
+
+    def extract():
+        while True:
+            res = downloaded.get()
+            if res is None:
+                return
+            try:
+                t0 = time.time()
+                extract_slc(res['path'], path, swaths, polarization)
+                # topsApp reads the SAFE: the zip is only disk used twice (when it
+                # came through the node cache, the cached copy stays there)
+                os.remove(res['path'])
+                res['extract_seconds'] = time.time() - t0
+                logger.info("download_and_extract_slcs : extracted {} in {:.1f} s".format(
+                    res['path'], res['extract_seconds']))
+            except Exception as err:
+                # keep draining the queue so that downloads never block
+                errors.append(err)
+
+    extractors = [threading.Thread(target=extract, daemon=True) for _ in range(extract_workers)]
+    for thread in extractors:
+        thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max_files) as pool:
+            futures = [pool.submit(download, slc) for slc in slcs]
+        results = [future.result() for future in futures]
+    finally:
+        for _ in extractors:
+            downloaded.put(None)
+        for thread in extractors:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return results
         
 def get_start_end_times(localize_slcs):
-    #"S1A_IW_SLC__1SDV_20200511T135117_20200511T135144_032518_03C421_7768"
-    import re
-    import datetime
-    
-    start_times = []
-    end_times = []
-    SLC_RE1 = re.compile(r'(?P<mission>S1\w)_IW_SLC__.*?_(?P<start_time>\d{8}T\d{6})_(?P<end_time>\d{8}T\d{6})_.*$')
-    for slc in localize_slcs:
-        match = SLC_RE1.search(slc)
-        if not match:
-            raise RuntimeError("Failed to recognize SLC ID %s." %slc)
-        start_time_str = "{}".format(match.group('start_time'))
-        start_times.append(datetime.datetime.strptime(start_time_str, '%Y%m%dT%H%M%S'))
-        end_time_str = "{}".format(match.group('end_time'))
-        end_times.append(datetime.datetime.strptime(end_time_str, '%Y%m%dT%H%M%S'))
-    return sorted(start_times)[0], sorted(end_times)[-1]
+    '''
+        Earliest start and latest end time over SLC IDs such as
+        S1A_IW_SLC__1SDV_20200511T135117_20200511T135144_032518_03C421_7768.
+    '''
+    times = [parse_granule_name(slc)[2:] for slc in localize_slcs]
+    return min(start for start, _ in times), max(end for _, end in times)
                                      
         
 def xml2string(xmlroot, encoding="UTF-8", method="xml", indent="\t", newl="\n"):
@@ -595,14 +1325,14 @@ def xml2string(xmlroot, encoding="UTF-8", method="xml", indent="\t", newl="\n"):
         .toprettyxml(newl=newl, indent=indent)
     return xmlstring
 
-def create_xml(xml_file, doc_type, slcs):
+def create_xml(xml_file, doc_type, slcs, safe_ext="zip"):
     from xml.dom import minidom 
     import xml.etree.cElementTree as ET
     import os 
    
     slc_list = []
     for slc in slcs:
-        slc_list.append(os.path.join('../data/slcs/', "{}.zip".format(slc)))
+        slc_list.append(os.path.join('../data/slcs/', "{}.{}".format(slc, safe_ext)))
 
     
 
@@ -648,15 +1378,19 @@ def create_dataset_json(id, version, met_file, ds_file):
         
         logger.info("create_dataset_json : met['bbox']: %s" %md['bbox'])
         
-        coordinates = [
-                    [
-                      [ md['bbox'][0][1], md['bbox'][0][0] ],
-                      [ md['bbox'][3][1], md['bbox'][3][0] ],
-                      [ md['bbox'][2][1], md['bbox'][2][0] ],
-                      [ md['bbox'][1][1], md['bbox'][1][0] ],
-                      [ md['bbox'][0][1], md['bbox'][0][0] ]
-                    ] 
-                  ]
+        # the footprint of the valid data when known, the requested bbox otherwise
+        if 'footprint' in md:
+            coordinates = md['footprint']['coordinates']
+        else:
+            coordinates = [
+                        [
+                          [ md['bbox'][0][1], md['bbox'][0][0] ],
+                          [ md['bbox'][3][1], md['bbox'][3][0] ],
+                          [ md['bbox'][2][1], md['bbox'][2][0] ],
+                          [ md['bbox'][1][1], md['bbox'][1][0] ],
+                          [ md['bbox'][0][1], md['bbox'][0][0] ]
+                        ] 
+                      ]
         
      
         #coordinates = md['union_geojson']['coordinates']
@@ -707,7 +1441,7 @@ def get_tops_subswath_xml(masterdir):
     logger.info("get_tops_subswath_xml from : %s" %masterdir)
 
     masterdir = os.path.abspath(masterdir)
-    IWs = glob(os.path.join(masterdir,'IW*.xml'))
+    IWs = glob.glob(os.path.join(masterdir,'IW*.xml'))
     if len(IWs)<1:
         raise Exception("Could not find a IW*.xml file in " + masterdir)
 
@@ -738,31 +1472,40 @@ def get_tops_metadata(masterdir):
     logger.info("get_tops_metadata from : %s" %masterdir)
     # get a list of avialble xml files for IW*.xml
     IWs = get_tops_subswath_xml(masterdir)
-    # append all swaths togheter
+    # append all swaths togheter, reading only the burst sensing times
     frames=[]
     for IW  in IWs:
         logger.info("get_tops_metadata processing : %s" %IW)
-        obj = read_isce_product(IW)
-        frames.append(obj)
+        frames.append(read_sensing_times(IW))
 
     output={}
-    dt = min(frame.sensingStart for frame in frames)
+    dt = min(start for start, stop in frames)
     output['sensingStart'] =  dt.isoformat('T') + 'Z'
     logger.info(dt)
-    dt = max(frame.sensingStop for frame in frames)
+    dt = max(stop for start, stop in frames)
     output['sensingStop'] = dt.isoformat('T') + 'Z'
     logger.info(dt)
     return output
         
-def extract_slc_data(slc_dir, slcs):
+def extract_slc(zip_file, out_dir, swaths=None, polarization=None):
+    '''
+        Unzip an SLC into out_dir. When swaths or polarization are given only
+        manifest.safe and the files of those swaths / that polarization are
+        written.
+    '''
     from zipfile import ZipFile
+    if swaths is None and polarization is None:
+        with ZipFile(zip_file, 'r') as zf:
+            zf.extractall(out_dir)
+    else:
+        extract_safe(zip_file, out_dir, swaths, polarization)
+
+def extract_slc_data(slc_dir, slcs, swaths=None, polarization=None):
     os.chdir(slc_dir)
     for slc in slcs:
-        i = "{}.zip".format(slc)
-        with ZipFile(i, 'r') as zf:
-            zf.extractall()
+        extract_slc("{}.zip".format(slc), slc_dir, swaths, polarization)
             
-def create_product(insar_dir, tops_properties, data_dict):
+def create_product(insar_dir, tops_properties, data_dict, run_cache=RUN_CACHE):
             
     from datetime import datetime
     from glob import glob
@@ -771,6 +1514,9 @@ def create_product(insar_dir, tops_properties, data_dict):
     os.chdir(insar_dir)
     print(insar_dir)
 
+    # keyed before tops_properties is extended into the met.json below
+    run_key, run_config = get_product_run_key(tops_properties, data_dict)
+
     #output = get_tops_metadata('fine_interferogram')
     #sensing_start= output['sensingStart']
     #sensing_stop = output['sensingStop']
@@ -805,7 +1551,29 @@ def create_product(insar_dir, tops_properties, data_dict):
 
     bbox = [[min_lat, min_lon], [min_lat, max_lon], [max_lat, max_lon], [max_lat, min_lon]]
     met['bbox'] =  bbox 
-    version = "v1.0"
+    version = PRODUCT_VERSION
+
+    # link (or reflink) rather than copy, checksumming in the same pass
+    merged_dir = os.path.join(insar_dir, "merged")
+    input_paths = [path for path in glob("{}/*".format(merged_dir)) if os.path.isfile(path)]
+    checksums = stage_files(input_paths, prod_dir)
+    for cog in convert_product_layers(prod_dir):
+        checksums[os.path.basename(cog)] = {'size': os.path.getsize(cog), 'method': 'cog',
+                                            'md5': hash_file(cog)}
+    # browse images go in before the checksums are written, so they are covered too
+    browse_index_file = os.path.join(prod_dir, "{}.browse.json".format(dataset_name))
+    browse_index = generate_browse_images([prod_dir], browse_index_file)
+    for name in browse_files(browse_index)[dataset_name] + [os.path.basename(browse_index_file)]:
+        path = os.path.join(prod_dir, name)
+        checksums[name] = {'size': os.path.getsize(path), 'method': 'browse',
+                           'md5': hash_file(path)}
+    with open(os.path.join(prod_dir, "{}.checksums.json".format(dataset_name)), 'w') as f:
+        json.dump(checksums, f, indent=2)
+
+    # footprint of the valid data, read from the COG overviews
+    footprint = get_product_footprint(prod_dir)
+    if footprint is not None:
+        met['footprint'] = {'type': 'Polygon', 'coordinates': footprint}
 
     # generate dataset JSON
     with open(met_file, 'w') as f: json.dump(met, f, indent=2)
@@ -814,26 +1582,19 @@ def create_product(insar_dir, tops_properties, data_dict):
     ds_file = os.path.join(prod_dir, "{}.dataset.json".format(dataset_name))
     create_dataset_json(dataset_name, version, met_file, ds_file)
 
-    merged_dir = os.path.join(insar_dir, "merged")
-    for name in glob("{}/*".format(merged_dir)):
-    
-        input_path = os.path.join(merged_dir, name)
-        print(input_path)
-        if os.path.isfile(input_path):
-            #print("Copying {} to {}".format(input_path,  prod_dir ))
-            shutil.copy(input_path,  prod_dir)
+    if run_cache is not None:
+        RunCache(run_cache).record(run_key, prod_dir, run_config)
     return prod_dir
             
-def create_topsApp_xml(tops_properties, input_dict):
+def create_topsApp_xml(tops_properties, input_dict, tops_xml_file=None):
     from xml.dom import minidom 
     import xml.etree.cElementTree as ET
     import os 
 
-    supported_docs = os.path.join(tutorial_home_dir, 'support_docs', 'insar')
-    os.makedirs(supported_docs, exist_ok=True)
-
-
-    tops_xml_file = os.path.join(tutorial_home_dir, "support_docs/insar/topsApp.xml")
+    if tops_xml_file is None:
+        supported_docs = os.path.join(tutorial_home_dir, 'support_docs', 'insar')
+        os.makedirs(supported_docs, exist_ok=True)
+        tops_xml_file = os.path.join(tutorial_home_dir, "support_docs/insar/topsApp.xml")
 
     root = ET.Element("topsApp")
 
@@ -870,3 +1631,207 @@ def create_topsApp_xml(tops_properties, input_dict):
     with open(tops_xml_file, 'w') as fw:
         #fw.write(r'<?xml version="1.0" encoding="UTF-8"?>\n')
         fw.write(xml_str)
+
+def get_pair_run_key(tops_properties, reference_slcs, secondary_slcs, bbox,
+                     sensor_name="SENTINEL1", end="geocode", kind="product"):
+    '''
+        (run cache key, config) of processing a pair with tops_properties up
+        to the step end into a result of the given kind ("product" or
+        "workdir"), see run_cache.get_run_config.
+    '''
+    config = get_run_config(tops_properties, reference_slcs, secondary_slcs, bbox, sensor_name,
+                            end, get_software_versions({'product': PRODUCT_VERSION}), kind)
+    return get_run_key(config), config
+
+def get_product_run_key(tops_properties, data_dict):
+    '''Run cache key and config of the product create_product makes from data_dict.'''
+    bbox = [data_dict["min_lat"], data_dict["max_lat"], data_dict["min_lon"], data_dict["max_lon"]]
+    return get_pair_run_key(tops_properties, data_dict["reference_slcs"],
+                            data_dict["secondary_slcs"], bbox,
+                            data_dict.get("sensor_name", sensor_name), kind="product")
+
+def is_product_dir(prod_dir):
+    '''True if prod_dir holds the met and dataset JSON that create_product writes last.'''
+    dataset_name = os.path.basename(os.path.normpath(prod_dir))
+    return all(os.path.isfile(os.path.join(prod_dir, "{}.{}.json".format(dataset_name, ext)))
+               for ext in ("met", "dataset"))
+
+def find_cached_product(tops_properties, data_dict, run_cache=RUN_CACHE):
+    '''
+        Directory of a product made earlier by create_product from the same
+        configuration, SLCs and software, or None if this run is new or the
+        cached directory is not a complete product.
+    '''
+    key, _ = get_product_run_key(tops_properties, data_dict)
+    prod_dir = RunCache(run_cache).lookup(key)
+    if prod_dir is not None and not is_product_dir(prod_dir):
+        logger.info("find_cached_product : {} : {} has no met/dataset JSON, ignoring it".format(
+            key, prod_dir))
+        prod_dir = None
+    logger.info("find_cached_product : {} : {}".format(key, prod_dir or "not cached"))
+    return prod_dir
+
+def record_cached_product(tops_properties, data_dict, prod_dir, run_cache=RUN_CACHE):
+    '''
+        Make find_cached_product(tops_properties, data_dict) return prod_dir,
+        e.g. for the inputs a job was submitted with, before its SLC plan
+        narrowed them down.
+    '''
+    key, config = get_product_run_key(tops_properties, data_dict)
+    RunCache(run_cache).record(key, prod_dir, config)
+
+def keep_pair_slcs(reference_slcs, secondary_slcs, kept, reasons=None):
+    '''
+        (reference_slcs, secondary_slcs) limited to the SLCs in kept. Raises
+        RuntimeError, with the reasons SLCs were dropped, if a side is empty.
+    '''
+    kept = set(kept)
+    reference_slcs = [slc for slc in reference_slcs if slc in kept]
+    secondary_slcs = [slc for slc in secondary_slcs if slc in kept]
+    if not reference_slcs or not secondary_slcs:
+        raise RuntimeError("No {} SLC has bursts in the AOI: {}".format(
+            'reference' if not reference_slcs else 'secondary', reasons))
+    return reference_slcs, secondary_slcs
+
+def get_pair_name(reference_slcs, secondary_slcs):
+    '''Work directory name of a pair: <reference date>_<secondary date>.'''
+    dates = []
+    for slcs in (reference_slcs, secondary_slcs):
+        start_time, _ = get_start_end_times(slcs)
+        dates.append(start_time.strftime('%Y%m%d'))
+    return "_".join(dates)
+
+def get_pair_workers(n_pairs, threads_per_pair=4, mem_per_pair_gb=8):
+    '''
+        Number of pairs to run at once: bounded by the cores (threads_per_pair
+        each), the available memory (mem_per_pair_gb each) and n_pairs.
+    '''
+    cores = len(os.sched_getaffinity(0))
+    with open('/proc/meminfo') as f:
+        meminfo = dict(line.split(':', 1) for line in f)
+    mem_gb = int(meminfo['MemAvailable'].split()[0]) / 1024**2
+    workers = max(1, min(cores // threads_per_pair, int(mem_gb // mem_per_pair_gb), n_pairs))
+    logger.info("get_pair_workers : {} pairs at once ({} cores, {:.0f} GB available)".format(
+        workers, cores, mem_gb))
+    return workers
+
+def link_shared_inputs(pair_dir, dem_dir, dem_name, aux_dir):
+    '''Symlink the shared DEM (with its headers) and AuxDir into a pair directory.'''
+    for src in glob.glob(os.path.join(dem_dir, dem_name + '*')) + [aux_dir]:
+        dest = os.path.join(pair_dir, os.path.basename(src))
+        if os.path.lexists(dest):
+            os.remove(dest)
+        os.symlink(os.path.abspath(src), dest)
+
+def run_topsApp_batch(pairs, batch_dir, min_lat, max_lat, min_lon, max_lon, tops_properties,
+                      sensor_name="SENTINEL1", start="startup", end="geocode", max_workers=None,
+                      threads_per_pair=4, mem_per_pair_gb=8, run_cache=RUN_CACHE, dry_run=False):
+    '''
+        Process a network of interferograms over one AOI in a single job.
+        pairs is a list of (reference_slcs, secondary_slcs). SLCs, orbits, the
+        DEM and AuxDir are staged once under batch_dir (data/slcs, data/orbits,
+        dem, AuxDir) and each pair runs run_topsApp_steps in its own
+        batch_dir/<reference date>_<secondary date> directory linked to them.
+        Pairs run max_workers at a time, by default as many as the node's cores
+        and memory allow. Returns {pair name: manifest or error message} and
+        writes it to batch_dir/batch.json.
+
+        Pairs already processed with the same configuration, SLCs and software
+        (per the run cache, unless run_cache is None) are not run again: their
+        result is {'cached': <directory>}. With dry_run, nothing is staged or
+        run and {pair name: {'key', 'cached'}} is returned and written to
+        batch_dir/batch_plan.json instead.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    batch_dir = os.path.abspath(batch_dir)
+    tops_properties = dict(tops_properties)
+    tops_properties.setdefault("region of interest", "[{}, {}, {}, {}]".format(
+        min_lat, max_lat, min_lon, max_lon))
+    bbox = [min_lat, max_lat, min_lon, max_lon]
+
+    cache = RunCache(run_cache) if run_cache is not None else None
+    keys = {}
+    configs = {}
+    cached = {}
+    for reference_slcs, secondary_slcs in pairs:
+        name = get_pair_name(reference_slcs, secondary_slcs)
+        # work directories, never confused with the products of create_product
+        keys[name], configs[name] = get_pair_run_key(tops_properties, reference_slcs,
+                                                     secondary_slcs, bbox, sensor_name, end,
+                                                     kind="workdir")
+        hit = cache.lookup(keys[name]) if cache is not None else None
+        if hit is not None:
+            cached[name] = hit
+    logger.info("run_topsApp_batch : {} of {} pairs in the run cache".format(len(cached),
+                                                                             len(keys)))
+    if dry_run:
+        report = {name: {'key': key, 'cached': cached.get(name)} for name, key in keys.items()}
+        os.makedirs(batch_dir, exist_ok=True)
+        with open(os.path.join(batch_dir, 'batch_plan.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        for name in sorted(report):
+            logger.info("run_topsApp_batch : dry run : {} : {}".format(
+                name, cached.get(name, "to process")))
+        return report
+    pairs = [(reference_slcs, secondary_slcs) for reference_slcs, secondary_slcs in pairs
+             if get_pair_name(reference_slcs, secondary_slcs) not in cached]
+    results = {name: {'cached': prod_dir} for name, prod_dir in cached.items()}
+    if not pairs:
+        os.makedirs(batch_dir, exist_ok=True)
+        with open(os.path.join(batch_dir, 'batch.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        return results
+
+    slc_dir = os.path.join(batch_dir, 'data', 'slcs')
+    orbit_dir = os.path.join(batch_dir, 'data', 'orbits')
+    dem_dir = os.path.join(batch_dir, 'dem')
+    aux_dir = os.path.join(batch_dir, 'AuxDir')
+    for directory in (slc_dir, orbit_dir, dem_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    # stage the inputs shared by all pairs once
+    localize_slcs = sorted(set(slc for reference_slcs, secondary_slcs in pairs
+                               for slc in reference_slcs + secondary_slcs))
+    download_slcs(localize_slcs, slc_dir)
+    get_orbit_files(localize_slcs, orbit_dir)
+    dem_name = download_dem(min_lat, max_lat, min_lon, max_lon, out_dir=dem_dir)
+    get_aux_cal(localize_slcs, aux_dir)
+
+    input_dict = {'sensor_name': sensor_name, 'wgs84_file': os.path.join('.', dem_name)}
+
+    pair_dirs = {}
+    for reference_slcs, secondary_slcs in pairs:
+        name = get_pair_name(reference_slcs, secondary_slcs)
+        pair_dir = os.path.join(batch_dir, name)
+        os.makedirs(pair_dir, exist_ok=True)
+        link_shared_inputs(pair_dir, dem_dir, dem_name, aux_dir)
+        create_xml(os.path.join(pair_dir, 'reference.xml'), 'reference', reference_slcs)
+        create_xml(os.path.join(pair_dir, 'secondary.xml'), 'secondary', secondary_slcs)
+        create_topsApp_xml(tops_properties, input_dict, os.path.join(pair_dir, 'topsApp.xml'))
+        pair_dirs[name] = pair_dir
+
+    if max_workers is None:
+        max_workers = get_pair_workers(len(pair_dirs), threads_per_pair, mem_per_pair_gb)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads_per_pair))
+
+    def run_pair(name):
+        try:
+            manifest = run_topsApp_steps(pair_dirs[name], start, end, env=env)
+            if cache is not None:
+                cache.record(keys[name], pair_dirs[name], configs[name])
+            return name, manifest
+        except Exception as e:
+            logger.error("run_topsApp_batch : {} failed: {}".format(name, e))
+            return name, {'error': str(e)}
+
+    # each worker drives one topsApp.py process at a time
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results.update(pool.map(run_pair, sorted(pair_dirs)))
+
+    with open(os.path.join(batch_dir, 'batch.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+    failed = [name for name, result in results.items() if 'error' in result]
+    logger.info("run_topsApp_batch : {} of {} pairs done".format(len(results) - len(failed),
+                                                                len(results)))
+    return results
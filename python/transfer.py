@@ -0,0 +1,509 @@
+# Suite of functionalities for transferring large input files over HTTP
+
+#Copyright 2021, by the California Institute of Technology. ALL RIGHTS RESERVED. United States Government sponsorship acknowledged. Any commercial use must be negotiated with the Office of Technology Transfer at the California Institute of Technology.</font>
+#This software may be subject to U.S. export control laws and regulations. By accepting this document, the user agrees to comply with all applicable U.S. export laws and regulations. User has the responsibility to obtain export licenses, or other export authority as may be required, before exporting such information to foreign countries or providing access to foreign persons.<font>
+
+"""Parallel, resumable downloads of large files (SLC zips, orbits, aux files).
+
+Each file is split into HTTP byte-range chunks that are fetched concurrently
+into a ``<file>.part`` file. Completed chunks are recorded in a
+``<file>.part.json`` sidecar so that a download interrupted by a preempted
+worker picks up where it stopped. Several files can be fetched at once, and
+an optional rate limiter caps the aggregate bandwidth.
+
+HTTPRangeFile exposes a remote file as a seekable file object, for readers
+that only need a few parts of a large archive.
+
+All fetchers share one TransferClient (see get_client): a pooled, keep-alive
+requests session that retries 429/5xx responses with exponential backoff and
+keeps per-host request, retry, error and byte counters.
+
+HedgedDownloader races a download against a copy in an S3 mirror bucket when
+the primary server is slow or failing.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('create_ifg')
+
+MB = 1024 * 1024
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TransferClient:
+    """Thread-safe HTTP client shared by the orbit, SLC and aux file fetchers.
+
+    pool_maxsize   : connections kept alive per host
+    retries        : attempts on connection errors and RETRY_STATUS responses
+    backoff_factor : exponential backoff base in seconds (Retry-After wins)
+    """
+
+    def __init__(self, pool_maxsize=32, retries=5, backoff_factor=1.0, timeout=60):
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS, allowed_methods=frozenset(['GET', 'HEAD']),
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.host_metrics = {}
+
+    def _host_metrics(self, url):
+        host = urlparse(url).netloc
+        if host not in self.host_metrics:
+            self.host_metrics[host] = {'requests': 0, 'retries': 0, 'errors': 0,
+                                       'bytes': 0, 'seconds': 0.0}
+        return self.host_metrics[host]
+
+    def get(self, url, **kwargs):
+        '''requests.get through the pooled session, recording per-host metrics.'''
+        kwargs.setdefault('timeout', self.timeout)
+        t0 = time.time()
+        try:
+            r = self.session.get(url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self._host_metrics(url)['errors'] += 1
+            raise
+        retries = getattr(r.raw, 'retries', None)
+        with self.lock:
+            # keyed on the requested host, like the failures above, not the redirect target
+            metrics = self._host_metrics(url)
+            metrics['requests'] += 1
+            metrics['seconds'] += time.time() - t0
+            if retries is not None:
+                metrics['retries'] += len(retries.history)
+            if r.status_code >= 400:
+                metrics['errors'] += 1
+            if not kwargs.get('stream'):
+                metrics['bytes'] += len(r.content)
+        return r
+
+    def add_bytes(self, url, nbytes, seconds=0.0):
+        '''Account for bytes read from a streamed response.'''
+        with self.lock:
+            metrics = self._host_metrics(url)
+            metrics['bytes'] += nbytes
+            metrics['seconds'] += seconds
+
+    def metrics(self):
+        with self.lock:
+            return {host: dict(values) for host, values in self.host_metrics.items()}
+
+    def log_metrics(self):
+        for host, m in sorted(self.metrics().items()):
+            rate = m['bytes'] / m['seconds'] / MB if m['seconds'] else 0.0
+            logger.info("{} : {} requests, {} retries, {} errors, {:.1f} MB, {:.1f} MB/s".format(
+                host, m['requests'], m['retries'], m['errors'], m['bytes'] / MB, rate))
+
+
+def requested_url(r):
+    '''URL that was asked for to get response r, before any redirect.'''
+    return r.history[0].url if r.history else r.url
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''The process-wide TransferClient, created on first use.'''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = TransferClient()
+        return _client
+
+
+class RateLimiter:
+    """Token bucket shared by all download threads to cap total bandwidth."""
+
+    def __init__(self, max_bytes_per_sec):
+        self.rate = float(max_bytes_per_sec)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Block until ``nbytes`` may be transferred."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= nbytes or self.tokens >= self.rate:
+                    self.tokens -= nbytes
+                    return
+                wait = (nbytes - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ChunkedDownloader:
+    """Download files with parallel byte-range chunks and resume support.
+
+    max_files        : number of files downloaded at the same time
+    chunks_per_file  : number of concurrent range requests per file
+    chunk_size       : size of a single range request in bytes
+    max_bytes_per_sec: aggregate bandwidth cap over all files (None = no cap)
+    """
+
+    def __init__(self, max_files=4, chunks_per_file=4, chunk_size=64 * MB,
+                 max_bytes_per_sec=None, client=None, block_size=1 * MB):
+        self.max_files = max_files
+        self.chunks_per_file = chunks_per_file
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.client = client if client is not None else get_client()
+        self.limiter = RateLimiter(max_bytes_per_sec) if max_bytes_per_sec else None
+
+    def _get(self, url, **kwargs):
+        return self.client.get(url, stream=True, **kwargs)
+
+    def probe(self, url):
+        """Return (size, supports_ranges) for ``url``; size is None if unknown."""
+        r = self._get(url, headers={'Range': 'bytes=0-0'})
+        try:
+            r.raise_for_status()
+            if r.status_code == 206:
+                content_range = r.headers.get('Content-Range', '')
+                total = content_range.rsplit('/', 1)[-1]
+                return (int(total) if total.isdigit() else None), True
+            length = r.headers.get('Content-Length')
+            return (int(length) if length else None), False
+        finally:
+            r.close()
+
+    def _stream_to(self, r, fw, cancel=None, progress=None):
+        nbytes = 0
+        t0 = time.time()
+        try:
+            for block in r.iter_content(chunk_size=self.block_size):
+                if cancel is not None and cancel.is_set():
+                    raise RuntimeError("Download cancelled")
+                if not block:
+                    continue
+                if self.limiter is not None:
+                    self.limiter.consume(len(block))
+                fw.write(block)
+                nbytes += len(block)
+                if progress is not None:
+                    progress(len(block))
+        finally:
+            self.client.add_bytes(requested_url(r), nbytes, time.time() - t0)
+        return nbytes
+
+    def _fetch_chunk(self, url, part_file, start, end, cancel, progress):
+        r = self._get(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        try:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RuntimeError("Server ignored range request for {}".format(url))
+            with open(part_file, 'r+b') as fw:
+                fw.seek(start)
+                nbytes = self._stream_to(r, fw, cancel, progress)
+        finally:
+            r.close()
+        if nbytes != end - start + 1:
+            raise RuntimeError("Short read for {} bytes {}-{}: got {}".format(
+                url, start, end, nbytes))
+        return nbytes
+
+    def _download_single(self, url, path, part_file, cancel, progress):
+        r = self._get(url)
+        try:
+            r.raise_for_status()
+            with open(part_file, 'wb') as fw:
+                nbytes = self._stream_to(r, fw, cancel, progress)
+        finally:
+            r.close()
+        os.replace(part_file, path)
+        return nbytes
+
+    def download(self, url, path, cancel=None, progress=None):
+        """Download ``url`` to the file ``path``.
+
+        ``cancel`` is an optional threading.Event aborting the transfer when
+        set, ``progress`` an optional callable receiving each block size.
+        Returns a dict with the url, path, bytes transferred and wall time.
+        """
+        t0 = time.time()
+        part_file = path + '.part'
+        state_file = part_file + '.json'
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        size, ranges = self.probe(url)
+        if os.path.exists(path) and size is not None and os.path.getsize(path) == size:
+            logger.info("{} already downloaded, skipping".format(path))
+            return {'url': url, 'path': path, 'bytes': 0, 'seconds': 0.0}
+
+        if not ranges or size is None:
+            logger.info("Downloading {} as a single stream".format(url))
+            nbytes = self._download_single(url, path, part_file, cancel, progress)
+            return {'url': url, 'path': path, 'bytes': nbytes,
+                    'seconds': time.time() - t0}
+
+        chunks = [(start, min(start + self.chunk_size, size) - 1)
+                  for start in range(0, size, self.chunk_size)]
+
+        # resume a previous attempt if its layout matches this one
+        done = set()
+        if os.path.exists(part_file) and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+                if state['size'] == size and state['chunk_size'] == self.chunk_size:
+                    done = set(state['done'])
+                    logger.info("Resuming {}: {}/{} chunks present".format(
+                        path, len(done), len(chunks)))
+            except (ValueError, KeyError):
+                done = set()
+        if not done:
+            with open(part_file, 'wb') as fw:
+                fw.truncate(size)
+
+        lock = threading.Lock()
+
+        def save_state():
+            tmp_file = state_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'url': url, 'size': size, 'chunk_size': self.chunk_size,
+                           'done': sorted(done)}, f)
+            os.replace(tmp_file, state_file)
+
+        def fetch(i):
+            start, end = chunks[i]
+            nbytes = self._fetch_chunk(url, part_file, start, end, cancel, progress)
+            with lock:
+                done.add(i)
+                save_state()
+            return nbytes
+
+        todo = [i for i in range(len(chunks)) if i not in done]
+        with ThreadPoolExecutor(max_workers=self.chunks_per_file) as pool:
+            nbytes = sum(pool.map(fetch, todo))
+
+        os.replace(part_file, path)
+        os.remove(state_file)
+        seconds = time.time() - t0
+        logger.info("Downloaded {} ({:.1f} MB in {:.1f} s)".format(
+            path, nbytes / MB, seconds))
+        return {'url': url, 'path': path, 'bytes': nbytes, 'seconds': seconds}
+
+    def download_many(self, jobs):
+        """Download a list of (url, path) pairs, ``max_files`` at a time.
+
+        Returns the per-file results in the order of ``jobs``. The first
+        failure is raised after the other downloads have finished.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_files) as pool:
+            futures = [pool.submit(self.download, url, path) for url, path in jobs]
+        return [future.result() for future in futures]
+
+
+class HedgedDownloader:
+    """Race an HTTP download against the same object in an S3 mirror bucket.
+
+    The primary (e.g. ASF) download starts alone. When its throughput over
+    the last ``window`` seconds falls below ``min_bytes_per_sec`` after a
+    ``grace`` period, or when it fails, a parallel fetch from the S3 mirror is
+    started. The first transfer to finish wins and the other one is cancelled.
+    """
+
+    def __init__(self, bucket, downloader=None, min_bytes_per_sec=5 * MB,
+                 grace=30.0, window=10.0, poll=1.0):
+        self.bucket = bucket
+        self.downloader = downloader if downloader is not None else ChunkedDownloader()
+        self.min_bytes_per_sec = min_bytes_per_sec
+        self.grace = grace
+        self.window = window
+        self.poll = poll
+
+    def _download_mirror(self, key, path, cancel):
+        t0 = time.time()
+        mirror_file = path + '.mirror'
+        nbytes = [0]
+
+        def progress(n):
+            if cancel.is_set():
+                raise RuntimeError("Download cancelled")
+            nbytes[0] += n
+
+        try:
+            self.bucket.download_file(key, mirror_file, Callback=progress)
+        except Exception:
+            if os.path.exists(mirror_file):
+                os.remove(mirror_file)
+            raise
+        if cancel.is_set():
+            os.remove(mirror_file)
+            raise RuntimeError("Download cancelled")
+        os.replace(mirror_file, path)
+        return {'url': 's3://{}/{}'.format(self.bucket.name, key), 'path': path,
+                'bytes': nbytes[0], 'seconds': time.time() - t0}
+
+    def download(self, url, key, path):
+        """Download ``url`` to ``path``, hedging with ``key`` in the mirror bucket.
+
+        Returns the result of the winning transfer, with 'source' set to
+        'primary' or 'mirror'.
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        lock = threading.Lock()
+        samples = []
+        received = [0]
+
+        def progress(n):
+            with lock:
+                received[0] += n
+
+        cancel_primary = threading.Event()
+        cancel_mirror = threading.Event()
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            primary = pool.submit(self.downloader.download, url, path, cancel_primary, progress)
+            mirror = None
+            pending = {primary}
+            winner = None
+            while pending:
+                done, pending = wait(pending, timeout=self.poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None and winner is None:
+                        winner = future
+                    elif future.exception() is not None:
+                        logger.info("HedgedDownloader : {} transfer of {} failed : {}".format(
+                            'primary' if future is primary else 'mirror', path, future.exception()))
+                if winner is not None:
+                    break
+
+                now = time.monotonic()
+                with lock:
+                    samples.append((now, received[0]))
+                while samples and samples[0][0] < now - self.window:
+                    samples.pop(0)
+                rate = ((samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+                        if len(samples) > 1 and samples[-1][0] > samples[0][0] else None)
+                slow = (now - t0 > self.grace and rate is not None and rate < self.min_bytes_per_sec)
+                if mirror is None and (primary.done() or slow):
+                    logger.info("HedgedDownloader : starting mirror fetch of {} "
+                                "(primary {})".format(key, 'failed' if primary.done()
+                                                     else '{:.2f} MB/s'.format(rate / MB)))
+                    mirror = pool.submit(self._download_mirror, key, path, cancel_mirror)
+                    pending.add(mirror)
+
+            if winner is None:
+                # both transfers failed: report the primary error
+                raise primary.exception()
+            if winner is primary:
+                cancel_mirror.set()
+            else:
+                cancel_primary.set()
+
+        if winner is mirror:
+            for leftover in (path + '.part', path + '.part.json'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        result = dict(winner.result())
+        result['source'] = 'primary' if winner is primary else 'mirror'
+        logger.info("HedgedDownloader : {} won by {} ({:.1f} MB in {:.1f} s)".format(
+            path, result['source'], result['bytes'] / MB, result['seconds']))
+        return result
+
+
+class HTTPRangeFile:
+    """Read-only, seekable file object over HTTP byte-range requests.
+
+    Reads are served from a small read-ahead buffer, so that parsers doing
+    many small reads (zipfile, XML headers) issue few requests. Only the bytes
+    actually read are transferred, e.g. the central directory of a zip.
+    read_range() can be called from several threads; read()/seek() cannot.
+    """
+
+    def __init__(self, url, client=None, block_size=256 * 1024):
+        self.client = client if client is not None else get_client()
+        self.block_size = block_size
+        self.pos = 0
+        self.buffer = b''
+        self.buffer_start = 0
+        self.bytes_read = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        # resolve redirects (e.g. to a signed S3 URL) once and learn the size
+        r = self.client.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+        try:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RuntimeError("Server does not support range requests: {}".format(url))
+            self.url = r.url
+            self.size = int(r.headers['Content-Range'].rsplit('/', 1)[-1])
+        finally:
+            r.close()
+
+    def read_range(self, start, length):
+        '''Fetch ``length`` bytes at ``start`` with a single range request.'''
+        if length <= 0:
+            return b''
+        end = min(start + length, self.size) - 1
+        r = self.client.get(self.url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RuntimeError("Server ignored range request for {}".format(self.url))
+        with self.lock:
+            self.requests += 1
+            self.bytes_read += len(r.content)
+        return r.content
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = min(n, self.size - self.pos)
+        if n <= 0:
+            return b''
+        offset = self.pos - self.buffer_start
+        if not (0 <= offset and offset + n <= len(self.buffer)):
+            self.buffer_start = self.pos
+            self.buffer = self.read_range(self.pos, max(n, self.block_size))
+            offset = 0
+        data = self.buffer[offset:offset + n]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        elif whence == os.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()